@@ -1,6 +1,11 @@
 # decorators.py
 from functools import wraps
-from flask import session, redirect, url_for, flash
+from flask import session, redirect, url_for, flash, g
+from .database import users
+
+# Enough for every route that needs the signed-in counselor/admin record
+_CURRENT_USER_FIELDS = {'name': 1, 'email': 1, 'role': 1, 'status': 1,
+                        'hashed_password': 1}
 
 
 def role_required(required_role):
@@ -38,3 +43,12 @@ def login_required(f):
             return redirect(url_for('IMHSS.counselor_login'))
         return f(*args, **kwargs)
     return wrapper
+
+
+def current_user():
+    """Signed-in counselor/admin record, looked up once per request"""
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = users.find_one(
+            {'_id': user_id}, _CURRENT_USER_FIELDS) if user_id else None
+    return g.current_user
@@ -0,0 +1,53 @@
+# User/cache.py - Small in-process caches for hot lookups
+import time
+import threading
+
+
+# ============================================
+# TTL CACHE
+# Per-process (each gunicorn worker keeps its own copy), so only cache
+# values that are cheap to be briefly stale or are invalidated on write.
+# ============================================
+class TTLCache:
+    """Thread-safe dict with per-entry expiry and a size cap"""
+
+    _MISSING = object()
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, self._MISSING)
+            if entry is self._MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        """Drop expired entries; if still full, drop the oldest insert"""
+        now = time.monotonic()
+        for key in [k for k, (_, exp) in self._data.items() if exp <= now]:
+            del self._data[key]
+        if len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]
@@ -1,18 +1,132 @@
 # User/chat.py - Student Chat Handler with Clinical Risk Detection
 import re
-import uuid
-import datetime
-from flask import jsonify, request, session
-from .database import students, messages, flags
+from re import _parser as sre_parse
+import secrets
+import functools
+from array import array
+import queue
+import atexit
+import threading
+import json
+import logging
+import logging.handlers
+import sys
+import random
+from flask import jsonify, request, session, Response
+from pymongo import UpdateOne
+from .database import students, messages, messages_w1, flags, utcnow
+from .cache import TTLCache
 import anthropic
 import os
 
 
+# ============================================
+# LOGGING
+# Records go onto a queue and a listener thread does the stdout write,
+# so a slow log pipe never stalls a chat request.
+# ============================================
+log = logging.getLogger("imhss.chat")
+log.setLevel(logging.INFO)
+log.propagate = False
+
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
 # ============================================
 # WEIGHTED RISK DETECTION ENGINE
 # Clinical-grade with context awareness
 # ============================================
 
+# _normalise runs on every message - build its tables and patterns once.
+# Single-character swaps go through str.translate (a plain C table
+# lookup) instead of a regex pass.
+_NORM_TABLE = str.maketrans({
+    **{char: ' ' for char in '-_./\\'},
+    **{char: "'" for char in '\u2018\u2019\u201c\u201d'},
+})
+# Anything that isn't a word character or apostrophe - whitespace
+# included - collapses to one space, so stripping and whitespace
+# folding are a single pass
+_NORM_SEPARATORS = re.compile(r"[^\w']+")
+
+
+# A pattern that is one whole word with at most one finite group of
+# endings, e.g. \bhopeless\b, \bdepress(ed|ing|ion)\b, \bsad(ness)?\b
+_WORD_FORMS = re.compile(r'\\b([a-z]*)(?:\(([a-z|]+)\)(\?)?)?([a-z]*)\\b')
+
+
+def _word_forms(pattern):
+    """Every word a single-word pattern can match, or None if it isn't one"""
+    parsed = _WORD_FORMS.fullmatch(pattern)
+    if not parsed:
+        return None
+    stem, endings, optional, tail = parsed.groups()
+    endings = endings.split('|') if endings else []
+    if optional or not endings:
+        endings.append('')
+    forms = {stem + ending + tail for ending in endings}
+    return None if '' in forms else forms
+
+
+def _required_literal(pattern):
+    """
+    Longest run of plain characters every match of the pattern must
+    contain ("self" for (kill|hurt|...)\w*\s+(my\s*)?self), or '' if
+    there is none. Only top-level literals count - anything inside a
+    group, class or repeat may not be there.
+    """
+    best = run = ''
+    for op, arg in sre_parse.parse(pattern):
+        if op is sre_parse.LITERAL:
+            run += chr(arg)
+        else:
+            best = max(best, run, key=len)
+            run = ''
+    return max(best, run, key=len)
+
+
+def _compile_tier(patterns, flags=0):
+    """
+    Split a tier of (pattern, label, weight) entries into a word table
+    and a list of prefiltered regexes.
+
+    Single-word patterns go in the word table, one key per surface form:
+    normalised text is only word characters, spaces and apostrophes, so
+    \bword\b matches exactly when the word is one of the message's
+    tokens - a dict lookup, no regex.
+
+    Every other pattern carries the literal it can't match without. A
+    substring test on that literal (plain C memchr/fastsearch) rules out
+    almost every pattern for a typical message, so only a handful of
+    real regex searches run. Indexes point into the label/weight arrays.
+    """
+    words = {}
+    regexes = []
+    for index, (pattern, _, _) in enumerate(patterns):
+        forms = _word_forms(pattern.pattern)
+        if forms:
+            for form in forms:
+                words.setdefault(form, []).append(index)
+        else:
+            regexes.append((
+                _required_literal(pattern.pattern),
+                index,
+                re.compile(pattern.pattern, flags),
+            ))
+
+    # Labels and weights as parallel arrays; weights are small ints, so a
+    # typed array keeps them unboxed
+    labels = tuple(label for _, label, _ in patterns)
+    weights = array('b', (weight for _, _, weight in patterns))
+    return words, regexes, labels, weights
+
+
 class RiskDetector:
     """
     Intelligent risk detection using weighted scoring.
@@ -30,12 +144,8 @@ class RiskDetector:
     @staticmethod
     def _normalise(text: str) -> str:
         """Normalize text for accurate pattern matching"""
-        text = text.lower()
-        text = re.sub(r'[-_./\\]', ' ', text)
-        text = re.sub(r'[\u2018\u2019\u201c\u201d]', "'", text)
-        text = re.sub(r"[^\w\s']", ' ', text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
+        text = text.lower().translate(_NORM_TABLE)
+        return _NORM_SEPARATORS.sub(' ', text).strip()
 
     # ════════════════════════════════════════════════════════════════
     # CRITICAL PATTERNS (Weight: 8 each - immediate high risk)
@@ -198,6 +308,26 @@ class RiskDetector:
         re.compile(r'\bdead\s+tired\b'),                         # "dead tired"
         re.compile(r'\bto\s+die\s+for\b'),                       # "to die for"
     ]
+    # Any hit vetoes the message, so the filters collapse into one search
+    _FALSE_POSITIVE_RE = re.compile('|'.join(
+        f'(?:{pattern.pattern})' for pattern in _FALSE_POSITIVE_PATTERNS
+    ))
+
+    # ════════════════════════════════════════════════════════════════
+    # COMPILED TIERS - word tables + literal-prefiltered regexes
+    # ════════════════════════════════════════════════════════════════
+    _TIERS = (
+        _compile_tier(_CRITICAL),
+        _compile_tier(_SEVERE),
+        _compile_tier(_MODERATE),
+    )
+    # Same tiers on sre's ASCII fast path for \w/\b. Only used when the
+    # text itself is ASCII, where both builds match identically.
+    _TIERS_ASCII = (
+        _compile_tier(_CRITICAL, re.ASCII),
+        _compile_tier(_SEVERE, re.ASCII),
+        _compile_tier(_MODERATE, re.ASCII),
+    )
 
     @staticmethod
     def detect(message_text: str):
@@ -208,49 +338,81 @@ class RiskDetector:
             tuple(risk_level: str, matched_keywords: list, score: int)
         """
         normalised = RiskDetector._normalise(message_text)
-        
+        risk_level, matched, score = RiskDetector._detect_cached(normalised)
+        return (risk_level, list(matched), score)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _detect_cached(normalised: str):
+        """
+        Score already-normalised text. Memoised because students resend
+        the same short messages ("hi", "thanks", "ok") all the time;
+        labels come back as a tuple so the cached value can't be mutated.
+        Call RiskDetector._detect_cached.cache_clear() if patterns change.
+        """
         # Check for false positives first
-        for pattern in RiskDetector._FALSE_POSITIVE_PATTERNS:
-            if pattern.search(normalised):
-                return ("none", [], 0)
+        if RiskDetector._FALSE_POSITIVE_RE.search(normalised):
+            return ("none", (), 0)
         
         score = 0
         matched = []
 
-        # Score all matches
-        for pattern, label, weight in RiskDetector._CRITICAL:
-            if pattern.search(normalised):
-                score += weight
-                if label not in matched:
-                    matched.append(label)
-
-        for pattern, label, weight in RiskDetector._SEVERE:
-            if pattern.search(normalised):
-                score += weight
-                if label not in matched:
-                    matched.append(label)
-
-        for pattern, label, weight in RiskDetector._MODERATE:
-            if pattern.search(normalised):
-                score += weight
+        # Score all matches - every tier, even past Red Code: the score and
+        # labels are stored on the flag and shown to the counselor. Labels
+        # keep pattern order within each tier.
+        tokens = set(normalised.replace("'", " ").split())
+        tiers = RiskDetector._TIERS_ASCII if normalised.isascii() else RiskDetector._TIERS
+        for words, regexes, labels, weights in tiers:
+            hits = set()
+            for token in tokens:
+                hits.update(words.get(token, ()))
+            hits.update(
+                index for literal, index, pattern in regexes
+                if literal in normalised and pattern.search(normalised)
+            )
+            for index in sorted(hits):
+                score += weights[index]
+                label = labels[index]
                 if label not in matched:
                     matched.append(label)
 
         # Determine risk level based on total score
         if score >= 8:
-            return ("high", matched, score)
+            return ("high", tuple(matched), score)
         elif score >= 4:
-            return ("medium", matched, score)
+            return ("medium", tuple(matched), score)
         elif score >= 3:
-            return ("low", matched, score)
+            return ("low", tuple(matched), score)
         else:
-            return ("none", [], 0)
+            return ("none", (), 0)
 
 
 # ============================================
 # AI RESPONSE HANDLER
 # ============================================
 
+# One client per process so HTTPS connections to the API are kept alive
+# between turns instead of re-handshaking on every message
+_ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+_anthropic_client = None
+_anthropic_lock = threading.Lock()
+
+
+def _get_anthropic_client():
+    global _anthropic_client
+    if _anthropic_client is None:
+        with _anthropic_lock:
+            if _anthropic_client is None:
+                # Fail fast on a stuck connection - the student is waiting
+                # and get_response has a fallback reply
+                _anthropic_client = anthropic.Anthropic(
+                    api_key=_ANTHROPIC_API_KEY,
+                    max_retries=2,
+                    timeout=anthropic.Timeout(20.0, connect=5.0),
+                )
+    return _anthropic_client
+
+
 class AIResponder:
     """Warm, context-aware AI companion"""
 
@@ -278,57 +440,232 @@ FOR CRISIS (suicidal thoughts, self-harm):
 
 RESPONSE LENGTH: 3-5 sentences."""
 
+    MODEL = "claude-haiku-4-5-20251001"
+    MAX_TOKENS = 500
+
+    FALLBACK_RESPONSES = [
+        "Something glitched — but I'm still here. What's weighing on you?",
+        "Quick hiccup on my side. Tell me what's going on.",
+        "Technical snag, but don't stop. What did you want to share?"
+    ]
+
+    # Bare greetings/thanks get a canned reply instead of a model call.
+    # Acks like "ok" / "yes" are left to the model - they depend on what
+    # was just asked.
+    _GREETINGS = {"hi", "hello", "hey", "hiya", "heya", "yo",
+                  "good morning", "good afternoon", "good evening"}
+    _THANKS = {"thanks", "thank you", "thx", "ty", "cheers"}
+
+    GREETING_RESPONSES = [
+        "Hey! Good to see you. How are you actually doing today?",
+        "Hi there. What's on your mind right now?",
+        "Hello! How's your day going so far — honestly?"
+    ]
+    THANKS_RESPONSES = [
+        "Anytime. I'm here whenever you want to talk.",
+        "Of course. Is there anything else on your mind?",
+        "Glad it helped. Come back whenever you need to."
+    ]
+
     @staticmethod
-    def get_response(student_message: str, conversation_history=None) -> str:
-        try:
-            client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-            api_messages = []
+    def canned_response(student_message: str, conversation_history=None):
+        """Return a stock reply for trivial openers/thanks, else None"""
+        normalised = RiskDetector._normalise(student_message)
+        if len(normalised.split()) > 2:
+            return None
+        # Greetings only open a conversation; mid-chat "hey" may be a
+        # bid for attention the model should handle
+        if normalised in AIResponder._GREETINGS and not conversation_history:
+            return random.choice(AIResponder.GREETING_RESPONSES)
+        if normalised in AIResponder._THANKS:
+            return random.choice(AIResponder.THANKS_RESPONSES)
+        return None
+
+    @staticmethod
+    def _build_messages(student_message: str, conversation_history=None) -> list:
+        api_messages = []
 
-            if conversation_history:
-                for msg in conversation_history:
-                    api_messages.append({"role": "user", "content": msg["content"]})
-                    if msg.get("ai_response"):
-                        api_messages.append({"role": "assistant", "content": msg["ai_response"]})
+        # History arrives newest-first (straight from the sorted query)
+        if conversation_history:
+            for msg in reversed(conversation_history):
+                api_messages.append({"role": "user", "content": msg["content"]})
+                if msg.get("ai_response"):
+                    api_messages.append({"role": "assistant", "content": msg["ai_response"]})
 
-            api_messages.append({"role": "user", "content": student_message})
+        api_messages.append({"role": "user", "content": student_message})
+        return api_messages
 
+    @staticmethod
+    def get_response(student_message: str, conversation_history=None) -> str:
+        try:
+            client = _get_anthropic_client()
             response = client.messages.create(
-                model="claude-haiku-4-5-20251001",
-                max_tokens=500,
+                model=AIResponder.MODEL,
+                max_tokens=AIResponder.MAX_TOKENS,
                 system=AIResponder.SYSTEM_PROMPT,
-                messages=api_messages
+                messages=AIResponder._build_messages(student_message, conversation_history)
             )
 
             return response.content[0].text
 
         except Exception as e:
-            print(f"AI API Error: {e}")
-            import random
-            return random.choice([
-                "Something glitched — but I'm still here. What's weighing on you?",
-                "Quick hiccup on my side. Tell me what's going on.",
-                "Technical snag, but don't stop. What did you want to share?"
-            ])
+            log.error("AI API Error: %s", e)
+            return random.choice(AIResponder.FALLBACK_RESPONSES)
+
+    @staticmethod
+    def stream_response(student_message: str, conversation_history=None):
+        """Yield the reply in text chunks as the model produces them"""
+        sent_any = False
+        try:
+            client = _get_anthropic_client()
+            with client.messages.stream(
+                model=AIResponder.MODEL,
+                max_tokens=AIResponder.MAX_TOKENS,
+                system=AIResponder.SYSTEM_PROMPT,
+                messages=AIResponder._build_messages(student_message, conversation_history)
+            ) as stream:
+                for text in stream.text_stream:
+                    sent_any = True
+                    yield text
+
+        except Exception as e:
+            log.error("AI API Error: %s", e)
+            # Only fall back if the student hasn't seen part of a reply
+            if not sent_any:
+                yield random.choice(AIResponder.FALLBACK_RESPONSES)
+
+
+# ============================================
+# BACKGROUND WRITER
+# ============================================
+# Message/flag inserts don't change the response, so they are handed to
+# a daemon thread instead of costing Mongo round trips per request. The
+# thread batches whatever has queued up into one insert per collection.
+
+_WRITE_QUEUE_SIZE = 1000
+_WRITE_BATCH_SIZE = 100
+_write_queue = queue.Queue(maxsize=_WRITE_QUEUE_SIZE)
+_writer_lock = threading.Lock()
+_writer_pid = None
+
+# counselor_id -> (check_notifications body, ETag). Dropped when this worker
+# writes a flag for the counselor; other workers catch up within the TTL.
+notifications_cache = TTLCache(ttl=15, maxsize=1024)
+
+
+def _store(batch):
+    """
+    Write a batch of (message_doc, flag_doc, reply) jobs - one write per
+    collection instead of one per document. Messages go first so a flag
+    never points at a message that isn't there yet; replies ((message_id,
+    ai_response) for a streamed message saved before its reply) go last.
+    """
+    message_docs = [job[0] for job in batch if job[0] is not None]
+    flag_docs = [job[1] for job in batch if job[1] is not None]
+    replies = [UpdateOne({"_id": job[2][0]},
+                         {"$set": {"ai_response": job[2][1]}})
+               for job in batch if job[2] is not None]
+    if message_docs:
+        try:
+            messages_w1.insert_many(message_docs, ordered=False)
+        except Exception as e:
+            log.error("Chat write error (messages): %s", e)
+    # Flags are written even if some messages failed - counselors must
+    # still be alerted
+    if flag_docs:
+        try:
+            flags.insert_many(flag_docs, ordered=False)
+        except Exception as e:
+            log.error("Chat write error (flags): %s", e)
+        for flag_doc in flag_docs:
+            notifications_cache.pop(flag_doc['counselor_id'])
+    if replies:
+        try:
+            messages_w1.bulk_write(replies, ordered=False)
+        except Exception as e:
+            log.error("Chat write error (replies): %s", e)
+
+
+def _drain():
+    while True:
+        # Block for one job, then sweep up whatever else is already queued
+        batch = [_write_queue.get()]
+        while len(batch) < _WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _store(batch)
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+
+def _ensure_writer():
+    """Start the writer on first use so each gunicorn worker gets its own"""
+    global _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid != os.getpid():
+            threading.Thread(target=_drain, name="chat-writer", daemon=True).start()
+            _writer_pid = os.getpid()
+
+
+def _queue_write(message_doc, flag_doc=None):
+    """Hand a write to the background thread; write inline if it is backed up"""
+    _ensure_writer()
+    try:
+        _write_queue.put_nowait((message_doc, flag_doc, None))
+    except queue.Full:
+        _store([(message_doc, flag_doc, None)])
+
+
+def _queue_reply(message_id, ai_response):
+    """
+    Queue the $set of a streamed reply onto its already-queued message.
+    Waits briefly for room rather than writing inline, so it can't
+    overtake the message insert still sitting in the queue.
+    """
+    _ensure_writer()
+    try:
+        _write_queue.put((None, None, (message_id, ai_response)), timeout=5)
+    except queue.Full:
+        _store([(None, None, (message_id, ai_response))])
+
+
+@atexit.register
+def _flush_writes():
+    """Don't lose queued writes when the worker shuts down"""
+    batch = []
+    while True:
+        try:
+            batch.append(_write_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _store(batch)
 
 
 # ============================================
 # CHAT ROUTE HANDLER
 # ============================================
 
+# student_id -> counselor_id. Assignments don't change after the
+# counselor registers the student, so a short TTL is plenty.
+_counselor_cache = TTLCache(ttl=300)
+
+# Only what the prompt needs from past turns
+_HISTORY_PROJECTION = {"content": 1, "ai_response": 1, "_id": 0}
+
+
 def send_message():
     """POST /student/chat/send"""
     
     if "student_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    student_id = session["student_id"]
-    student_record = students.find_one({"_id": student_id})
-
-    if not student_record:
-        return jsonify({"error": "Student not found"}), 404
-
-    counselor_id = student_record.get("counselor_id")
-
     data = request.get_json(silent=True)
     if not data or "message" not in data:
         return jsonify({"error": "Message required"}), 400
@@ -339,26 +676,86 @@ def send_message():
     if len(student_message) > 2000:
         return jsonify({"error": "Message too long"}), 400
 
-    session_id = data.get("session_id") or str(uuid.uuid4())
+    student_id = session["student_id"]
+    session_id = data.get("session_id") or secrets.token_hex(16)
 
     # Weighted risk detection
     risk_level, matched_keywords, risk_score = RiskDetector.detect(student_message)
-    flagged = risk_level in ("high", "medium")
 
-    # Get conversation history
-    conversation_history = list(
-        messages.find(
-            {"student_id": student_id, "session_id": session_id}
-        ).sort("timestamp", -1).limit(6)
-    )
-    conversation_history.reverse()
+    # Get counselor and conversation history (newest first)
+    counselor_id = _counselor_cache.get(student_id)
+
+    if counselor_id is not None:
+        conversation_history = list(
+            messages.find(
+                {"student_id": student_id, "session_id": session_id},
+                _HISTORY_PROJECTION
+            ).sort("timestamp", -1).limit(6)
+        )
+    else:
+        # Cache miss: fetch the student and their history in one round trip
+        student_record = next(students.aggregate([
+            {"$match": {"_id": student_id}},
+            {"$project": {"counselor_id": 1}},
+            {"$lookup": {
+                "from": "messages",
+                "pipeline": [
+                    {"$match": {"student_id": student_id, "session_id": session_id}},
+                    {"$sort": {"timestamp": -1}},
+                    {"$limit": 6},
+                    {"$project": _HISTORY_PROJECTION},
+                ],
+                "as": "history",
+            }},
+        ]), None)
+
+        if not student_record:
+            return jsonify({"error": "Student not found"}), 404
+
+        counselor_id = student_record.get("counselor_id")
+        conversation_history = student_record["history"]
+        # Not cached while unassigned - create-student sets it just after insert
+        if counselor_id:
+            _counselor_cache.set(student_id, counselor_id)
+
+    # Trivial greeting/thanks with no risk: skip the model entirely
+    canned = None
+    if risk_level == "none":
+        canned = AIResponder.canned_response(student_message, conversation_history)
+
+    # Streaming clients ({"stream": true}) get the reply as server-sent
+    # events; the message and any flag are queued before the stream
+    # starts, the reply is filled in once it closes.
+    if data.get("stream") and canned is None:
+        return _stream_reply(
+            student_message, conversation_history, student_id, counselor_id,
+            session_id, risk_level, risk_score, matched_keywords)
 
     # Get AI response
-    ai_response = AIResponder.get_response(student_message, conversation_history)
+    ai_response = canned or AIResponder.get_response(student_message, conversation_history)
+
+    message_id, timestamp = _save_exchange(
+        student_id, counselor_id, session_id, student_message, ai_response,
+        risk_level, risk_score, matched_keywords)
+
+    return jsonify({
+        "success": True,
+        "ai_response": ai_response,
+        "message_id": message_id,
+        "timestamp": timestamp.isoformat(),
+    }), 200
+
 
-    # Save message
-    message_id = str(uuid.uuid4())
-    timestamp = datetime.datetime.utcnow()
+def _save_exchange(student_id, counselor_id, session_id, student_message,
+                   ai_response, risk_level, risk_score, matched_keywords):
+    """Queue the message (and flag, if any) for storage"""
+    flagged = risk_level in ("high", "medium")
+
+    # Save message - one UTC timestamp shared by message and flag, naive
+    # like every other stored/returned date (see database.utcnow)
+    # Plain 128-bit hex keys - same strength as uuid4 without building a UUID
+    message_id = secrets.token_hex(16)
+    timestamp = utcnow()
 
     message_doc = {
         "_id": message_id,
@@ -372,12 +769,12 @@ def send_message():
         "flagged": flagged,
         "timestamp": timestamp,
     }
-    messages.insert_one(message_doc)
 
     # Create flag if needed
+    flag_doc = None
     if flagged:
         flag_doc = {
-            "_id": str(uuid.uuid4()),
+            "_id": secrets.token_hex(16),
             "message_id": message_id,
             "student_id": student_id,
             "counselor_id": counselor_id,
@@ -390,14 +787,42 @@ def send_message():
             "reviewed_by": None,
             "notes": None,
         }
-        flags.insert_one(flag_doc)
 
-        print(f"[{risk_level.upper()} - Score: {risk_score}] "
-              f"student={student_id} keywords={matched_keywords}")
+        log.info("[%s - Score: %s] student=%s keywords=%s",
+                 risk_level.upper(), risk_score, student_id, matched_keywords)
 
-    return jsonify({
-        "success": True,
-        "ai_response": ai_response,
-        "message_id": message_id,
-        "timestamp": timestamp.isoformat(),
-    }), 200
+    _queue_write(message_doc, flag_doc)
+    return message_id, timestamp
+
+
+def _stream_reply(student_message, conversation_history, student_id,
+                  counselor_id, session_id, risk_level, risk_score,
+                  matched_keywords):
+    """Relay the AI reply as server-sent events"""
+    # Message and flag are queued now, not when the stream closes - a
+    # counselor's alert must not wait on (or die with) the model's reply
+    message_id, timestamp = _save_exchange(
+        student_id, counselor_id, session_id, student_message,
+        "", risk_level, risk_score, matched_keywords)
+
+    def generate():
+        chunks = []
+        try:
+            for text in AIResponder.stream_response(student_message, conversation_history):
+                chunks.append(text)
+                yield f"data: {json.dumps({'delta': text})}\n\n"
+        finally:
+            # Runs on disconnect too, so whatever was streamed is kept
+            if chunks:
+                _queue_reply(message_id, "".join(chunks))
+
+        yield "data: " + json.dumps({
+            "done": True,
+            "message_id": message_id,
+            "timestamp": timestamp.isoformat(),
+        }) + "\n\n"
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
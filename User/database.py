@@ -1,8 +1,14 @@
 # User/database.py - Optimized Database Connection with Indexes
 import os
+import time
 import datetime
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ASCENDING, DESCENDING, WriteConcern, UpdateOne
+from pymongo import IndexModel, ReadPreference
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
+from .cache import TTLCache
 
 load_dotenv()
 
@@ -16,13 +22,21 @@ if not mongo_uri:
 client = MongoClient(
     mongo_uri,
     serverSelectionTimeoutMS=5000,      # 5 sec (was 3)
-    maxPoolSize=50,
-    minPoolSize=5,                       # Reduced from 10 to reduce connection overhead
-    maxIdleTimeMS=60000,                 # 60 sec (was 45)
+    # Pool per gunicorn worker, sized for its request threads plus the
+    # dashboard query pool (see gunicorn.conf.py) - N workers x 50 sockets
+    # eats the Atlas quota
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL", "20")),      # was 50
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL", "0")),       # was 5 - let idle sockets close
+    maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_MS", "30000")),  # 30 sec (was 60)
+    waitQueueTimeoutMS=2000,             # fail fast instead of queueing forever when the pool is exhausted
     connectTimeoutMS=20000,              # 20 sec (was 10)
     socketTimeoutMS=45000,               # 45 sec (was 20)
     retryWrites=True,                    # Auto-retry failed writes
     retryReads=True,                     # Auto-retry failed reads
+    # Chat bodies and dashboard listings compress well. The server picks
+    # the first one it also supports; zstd needs the zstandard package,
+    # zlib is always there.
+    compressors=os.getenv("MONGO_COMPRESSORS", "zstd,zlib"),
     w='majority'                         # Write concern for data safety
 )
 
@@ -36,12 +50,30 @@ messages = db.messages
 flags = db.flags
 logs = db.activity_logs
 
+# Chat transcripts are written in batches by a background thread, so a
+# primary-only ack is enough and saves the majority-replication wait.
+# Flags keep w='majority' - a lost flag means a missed alert.
+messages_w1 = messages.with_options(write_concern=WriteConcern(w=1))
+# Audit entries are advisory - fire and forget, don't hold the request
+# for an ack. Reads and anything else on logs use the normal handle.
+logs_fast = logs.with_options(write_concern=WriteConcern(w=0))
+# Same for last_login bookkeeping on staff logins. Nothing that matters
+# (passwords, status) goes through this handle.
+users_fast = users.with_options(write_concern=WriteConcern(w=0))
+
+
+def _read_only(collection):
+    """Handle that reads from a secondary when one is up - reporting only,
+    never for anything that must see a write this request just made"""
+    return collection.with_options(
+        read_preference=ReadPreference.SECONDARY_PREFERRED)
+
 # ============================================
 # PRIVATE COUNSELOR–STUDENT MESSAGES
 # Strictly private: accessible only to the counselor who sent the
 # message. No admin route imports or queries this collection.
 # Schema per document:
-#   _id            str  UUID
+#   _id            ObjectId
 #   counselor_id   str  session user_id of the sending counselor
 #   counselor_name str  display name of counselor
 #   counselor_email str email used as reply-to
@@ -51,7 +83,7 @@ logs = db.activity_logs
 #   subject        str
 #   body           str
 #   sent_at        datetime UTC
-#   email_status   str  "sent" | "failed"
+#   email_status   str  "queued" | "sent" | "failed"
 # ============================================
 counselor_messages = db.counselor_messages
 
@@ -61,10 +93,11 @@ counselor_messages = db.counselor_messages
 # Accessible only by the forgot/reset routes — no dashboard route
 # reads or writes this collection.
 # Schema per document:
-#   _id        str      UUID
+#   _id        ObjectId
 #   user_id    str      users._id of the requesting user
 #   email      str      for fast lookup on submit
-#   token      str      secrets.token_urlsafe(48) — URL-safe random
+#   token_hash str      hash_reset_token() of the emailed token; the
+#                       raw token is never stored
 #   created_at datetime UTC
 #   expires_at datetime UTC  (created_at + 1 hour)
 #   used       bool     True once the reset has been completed
@@ -72,88 +105,172 @@ counselor_messages = db.counselor_messages
 password_reset_tokens = db.password_reset_tokens
 
 
+def hash_access_token(token: str) -> str:
+    """
+    SHA-256 of a student access token. Logins look students up by this
+    (fixed-width, indexed) instead of the raw token, which is kept only
+    for counselors/admin to read back.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def hash_reset_token(token: str) -> str:
+    """Lookup key for a password reset token (only the hash is stored)"""
+    return hashlib.blake2b(token.encode(), digest_size=32).hexdigest()
+
+
+def utcnow():
+    """
+    Current UTC time as a naive datetime. The client is not tz_aware, so
+    dates read back are naive UTC; keep ours the same so they compare.
+    Replaces datetime.utcnow(), deprecated since Python 3.12.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 # ============================================
-# CREATE INDEXES FOR PERFORMANCE (AUTO-ENABLED)
+# CREATE INDEXES FOR PERFORMANCE
 # ============================================
-def setup_indexes():
-    try:
-        print("Setting up database indexes...")
 
-        users.create_index([("email", ASCENDING)], unique=True,
-                           background=True)
-        users.create_index([("role", ASCENDING)], background=True)
-        users.create_index([("status", ASCENDING)], background=True)
-        print("Users indexes created")
-
-        students.create_index([("email", ASCENDING)], unique=True,
-                              background=True)
-        students.create_index([("access_token", ASCENDING)], unique=True,
-                              background=True)
-        students.create_index([("counselor_id", ASCENDING)], background=True)
-        students.create_index([("token_used", ASCENDING)], background=True)
-        students.create_index([("token_expires_at", ASCENDING)],
-                              background=True)
-        students.create_index(
-            [("counselor_id", ASCENDING), ("token_expires_at", ASCENDING)],
-            background=True)
-        print("Students indexes created")
-
-        messages.create_index(
-            [("student_id", ASCENDING), ("timestamp", DESCENDING)],
-            background=True)
-        messages.create_index(
-            [("counselor_id", ASCENDING), ("timestamp", DESCENDING)],
-            background=True)
-        messages.create_index(
-            [("session_id", ASCENDING), ("timestamp", ASCENDING)],
-            background=True)
-        messages.create_index([("flagged", ASCENDING)], background=True)
-        messages.create_index([("risk_level", ASCENDING)], background=True)
-        messages.create_index([("timestamp", DESCENDING)], background=True)
-        print("Messages indexes created")
-
-        flags.create_index(
-            [("counselor_id", ASCENDING), ("reviewed", ASCENDING),
-             ("flagged_at", DESCENDING)], background=True)
-        flags.create_index(
-            [("student_id", ASCENDING), ("flagged_at", DESCENDING)],
-            background=True)
-        flags.create_index([("reviewed", ASCENDING)], background=True)
-        flags.create_index([("message_id", ASCENDING)], background=True)
-        flags.create_index(
-            [("risk_level", ASCENDING), ("reviewed", ASCENDING)],
-            background=True)
-        print("Flags indexes created")
-
-        logs.create_index([("timestamp", DESCENDING)], background=True)
-        logs.create_index(
-            [("user_id", ASCENDING), ("timestamp", DESCENDING)],
-            background=True)
-        print("Activity logs indexes created")
+# Hot queries pin these by name with hint= so a stats drift can't flip
+# them onto a worse plan.
+STUDENT_TOKEN_INDEX = "idx_student_token_hash"
+FLAG_COUNSELOR_INDEX = "idx_flag_counselor_reviewed_at"
 
-        # Counselor–Student private messages — scoped to counselor_id only
-        counselor_messages.create_index(
-            [("counselor_id", ASCENDING), ("sent_at", DESCENDING)],
-            background=True)
-        counselor_messages.create_index(
-            [("student_id", ASCENDING), ("sent_at", DESCENDING)],
-            background=True)
-        counselor_messages.create_index(
-            [("counselor_id", ASCENDING), ("student_id", ASCENDING),
-             ("sent_at", DESCENDING)], background=True)
-        print("Counselor messages indexes created")
+# Indexes earlier versions created that nothing queries any more.
+# (collection, index name) - dropped by setup_indexes if present.
+LEGACY_INDEXES = [
+    # superseded by (student_id, session_id, timestamp)
+    (messages, "session_id_1_timestamp_1"),
+    # logins look up access_token_hash; the raw token is display-only
+    (students, "access_token_1"),
+    # single-field indexes on booleans / 2-3 value enums: the planner
+    # rarely picks them and every write still pays for them
+    (users, "role_1"),
+    (users, "status_1"),
+    (students, "token_used_1"),
+    (messages, "flagged_1"),
+    (messages, "risk_level_1"),
+    (flags, "reviewed_1"),
+    # same keys, now created under the names hinted above
+    (students, "access_token_hash_1"),
+    (flags, "counselor_id_1_reviewed_1_flagged_at_-1"),
+    # reset tokens are looked up by token_hash; raw tokens aren't stored
+    (password_reset_tokens, "token_1"),
+    # prefix of (student_id, counselor_id, flagged_at)
+    (flags, "student_id_1_flagged_at_-1"),
+    # prefix of (counselor_id, token_expires_at)
+    (students, "counselor_id_1"),
+    # now carries the _id tie-break the keyset pagination sorts on
+    (flags, "student_id_1_counselor_id_1_flagged_at_-1"),
+    (messages, "student_id_1_timestamp_-1"),
+]
+
+
+def drop_legacy_indexes():
+    for collection, name in LEGACY_INDEXES:
+        try:
+            collection.drop_index(name)
+            print(f"Dropped legacy index {collection.name}.{name}")
+        except OperationFailure as e:
+            # IndexNotFound - already gone
+            if e.code != 27 and "index not found" not in str(e):
+                raise
 
+
+def backfill_access_token_hashes():
+    """Give students created before access_token_hash existed their hash"""
+    pending = students.find(
+        {"access_token": {"$exists": True},
+         "access_token_hash": {"$exists": False}},
+        {"access_token": 1}
+    )
+    ops = [
+        UpdateOne({"_id": s["_id"]},
+                  {"$set": {"access_token_hash": hash_access_token(s["access_token"])}})
+        for s in pending
+    ]
+    if ops:
+        students.bulk_write(ops, ordered=False)
+        print(f"Backfilled access_token_hash for {len(ops)} students")
+
+
+def _index_plan():
+    """(collection, label, [IndexModel]) for every collection we index"""
+    return [
+        (users, "Users", [
+            IndexModel([("email", ASCENDING)], unique=True),
+        ]),
+        (students, "Students", [
+            IndexModel([("email", ASCENDING)], unique=True),
+            IndexModel([("access_token_hash", ASCENDING)],
+                       unique=True, sparse=True, name=STUDENT_TOKEN_INDEX),
+            IndexModel([("token_expires_at", ASCENDING)]),
+            # also serves counselor_id alone (counselor_dashboard)
+            IndexModel([("counselor_id", ASCENDING),
+                        ("token_expires_at", ASCENDING)]),
+        ]),
+        (messages, "Messages", [
+            # _id is the tie-break chat-history keyset pagination sorts on
+            IndexModel([("student_id", ASCENDING), ("timestamp", DESCENDING),
+                        ("_id", DESCENDING)]),
+            IndexModel([("counselor_id", ASCENDING),
+                        ("timestamp", DESCENDING)]),
+            # Chat history: last N turns of one student's session
+            IndexModel([("student_id", ASCENDING), ("session_id", ASCENDING),
+                        ("timestamp", DESCENDING)]),
+            IndexModel([("timestamp", DESCENDING)]),
+        ]),
+        (flags, "Flags", [
+            IndexModel([("counselor_id", ASCENDING), ("reviewed", ASCENDING),
+                        ("flagged_at", DESCENDING)],
+                       name=FLAG_COUNSELOR_INDEX),
+            # a counselor's view of one student's flags, keyset-paginated
+            # newest first
+            IndexModel([("student_id", ASCENDING), ("counselor_id", ASCENDING),
+                        ("flagged_at", DESCENDING), ("_id", DESCENDING)]),
+            # distinct student_ids per counselor (covered) + messaging check
+            IndexModel([("counselor_id", ASCENDING), ("student_id", ASCENDING)]),
+            IndexModel([("message_id", ASCENDING)]),
+            # admin flag list, keyset-paginated newest first
+            IndexModel([("flagged_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("risk_level", ASCENDING), ("reviewed", ASCENDING)]),
+        ]),
+        (logs, "Activity logs", [
+            IndexModel([("timestamp", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)]),
+        ]),
+        # Counselor–Student private messages — scoped to counselor_id only
+        (counselor_messages, "Counselor messages", [
+            IndexModel([("counselor_id", ASCENDING), ("sent_at", DESCENDING)]),
+            IndexModel([("student_id", ASCENDING), ("sent_at", DESCENDING)]),
+            IndexModel([("counselor_id", ASCENDING), ("student_id", ASCENDING),
+                        ("sent_at", DESCENDING)]),
+        ]),
         # Password reset tokens
-        # token field is unique so duplicate tokens are impossible
-        password_reset_tokens.create_index(
-            [("token", ASCENDING)], unique=True, background=True)
-        password_reset_tokens.create_index(
-            [("email", ASCENDING), ("used", ASCENDING)], background=True)
-        password_reset_tokens.create_index(
-            [("expires_at", ASCENDING)], background=True,
-            expireAfterSeconds=0   # MongoDB TTL index — auto-deletes expired docs
-        )
-        print("Password reset token indexes created")
+        # token_hash is unique so duplicate tokens are impossible
+        (password_reset_tokens, "Password reset token", [
+            IndexModel([("token_hash", ASCENDING)], unique=True),
+            IndexModel([("email", ASCENDING), ("used", ASCENDING)]),
+            # MongoDB TTL index — auto-deletes expired docs
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]),
+    ]
+
+
+def setup_indexes():
+    """
+    Create every index with one createIndexes command per collection.
+    Idempotent - indexes that already exist are left alone by the server.
+    """
+    try:
+        print("Setting up database indexes...")
+        drop_legacy_indexes()
+        backfill_access_token_hashes()
+
+        for collection, label, models in _index_plan():
+            collection.create_indexes(models)
+            print(f"{label} indexes created")
 
         print("All database indexes created successfully!")
         return True
@@ -166,56 +283,105 @@ def setup_indexes():
 # ============================================
 # PERFORMANCE OPTIMIZATION UTILITIES
 # ============================================
+_stats_cache = TTLCache(ttl=10, maxsize=1)
+
+
 def get_collection_stats():
     """
+    Cached for 10s; a refresh runs the five counts in parallel.
+
     NOTE: counselor_messages and password_reset_tokens are intentionally
     excluded — admin must not see counts or content of private
     counselor–student correspondence or reset token activity.
     """
+    stats = _stats_cache.get("stats")
+    if stats is not None:
+        return stats
     try:
-        stats = {
-            "users": users.estimated_document_count(),
-            "students": students.estimated_document_count(),
-            "messages": messages.estimated_document_count(),
-            "flags": flags.estimated_document_count(),
-            "logs": logs.estimated_document_count()
-        }
+        collections = {name: _read_only(c) for name, c in (
+            ("users", users), ("students", students), ("messages", messages),
+            ("flags", flags), ("logs", logs))}
+        with ThreadPoolExecutor(max_workers=len(collections)) as pool:
+            futures = {name: pool.submit(c.estimated_document_count)
+                       for name, c in collections.items()}
+            stats = {name: f.result() for name, f in futures.items()}
+        _stats_cache.set("stats", stats)
         return stats
     except Exception as e:
         print(f"Error getting collection stats: {e}")
         return {}
 
 
-def cleanup_old_messages(days_to_keep=90):
+def cleanup_old_messages(days_to_keep=90, batch_size=1000, pause=0.05):
+    """
+    Delete messages older than days_to_keep in batches of batch_size,
+    pausing between batches so foreground writes and replication keep up.
+    """
     try:
         cutoff_date = (
-            datetime.datetime.utcnow() - datetime.timedelta(days=days_to_keep)
+            utcnow() - datetime.timedelta(days=days_to_keep)
         )
-        result = messages.delete_many({"timestamp": {"$lt": cutoff_date}})
-        print(f"Cleaned up {result.deleted_count} old messages")
-        return result.deleted_count
+        deleted = 0
+        while True:
+            ids = [d["_id"] for d in messages.find(
+                {"timestamp": {"$lt": cutoff_date}}, {"_id": 1}
+            ).limit(batch_size)]
+            if not ids:
+                break
+            deleted += messages.delete_many({"_id": {"$in": ids}}).deleted_count
+            time.sleep(pause)
+        print(f"Cleaned up {deleted} old messages")
+        return deleted
     except Exception as e:
         print(f"Error cleaning up messages: {e}")
         return 0
 
 
-def get_expired_tokens():
-    try:
-        now = datetime.datetime.utcnow()
-        expired_students = list(students.find({
-            "token_expires_at": {"$lt": now}
-        }).sort("token_expires_at", DESCENDING))
-        return expired_students
-    except Exception as e:
-        print(f"Error getting expired tokens: {e}")
-        return []
+def get_expired_tokens(counselor_id=None, batch_size=500):
+    """
+    Cursor over students whose access token has expired, newest expiry
+    first. Only the fields a token report needs are fetched.
+
+    Either way the order comes from walking an index backwards, never an
+    in-memory SORT: token_expires_at_1 unscoped, or the counselor_id +
+    token_expires_at compound when counselor_id is given.
+
+    The cursor is lazy - nothing runs until it is iterated, so server
+    errors surface there as PyMongoError and the caller handles them.
+    """
+    query = {"token_expires_at": {"$lt": utcnow()}}
+    projection = {"_id": 1, "name": 1, "email": 1, "counselor_id": 1,
+                  "token_expires_at": 1}
+    students_ro = _read_only(students)
+    if counselor_id is None:
+        cursor = students_ro.find(query, projection).sort(
+            "token_expires_at", DESCENDING)
+    else:
+        query["counselor_id"] = counselor_id
+        cursor = students_ro.find(query, projection).sort(
+            [("counselor_id", DESCENDING), ("token_expires_at", DESCENDING)]
+        ).hint([("counselor_id", ASCENDING), ("token_expires_at", ASCENDING)])
+    return cursor.batch_size(batch_size)
+
+
+def bounded_count(collection, query, cap, **kwargs):
+    """
+    count_documents() that stops after cap + 1 matches, for displays that
+    only show "cap+". Returns (count, capped); count never exceeds cap.
+    """
+    count = collection.count_documents(query, limit=cap + 1, **kwargs)
+    return min(count, cap), count > cap
 
 
 # ============================================
-# AUTO-RUN INDEX SETUP ON IMPORT
+# INDEX SETUP
+# Not run on import any more - every gunicorn worker paid ~25 round
+# trips at boot. Run once per deploy with `flask --app app ensure-indexes`
+# (see Procfile / render.yaml), or set IMHSS_RUN_INDEX_SETUP=1 to get the
+# old behaviour locally.
 # ============================================
-try:
-    setup_indexes()
-except Exception as e:
-    print(f"Warning: Could not setup indexes automatically: {e}")
-    print("Indexes will be created on next database operation")
+if os.getenv("IMHSS_RUN_INDEX_SETUP", "").lower() in ("1", "true"):
+    try:
+        setup_indexes()
+    except Exception as e:
+        print(f"Warning: Could not setup indexes automatically: {e}")
@@ -0,0 +1,92 @@
+# User/mailer.py - Send Flask-Mail messages off the request thread
+import os
+import queue
+import atexit
+import threading
+from flask import current_app
+from .database import counselor_messages
+
+
+# ============================================
+# BACKGROUND MAILER
+# An SMTP handshake with Gmail takes hundreds of ms to seconds; routes
+# enqueue the message and return, and a daemon thread per worker sends.
+# ============================================
+
+_MAIL_QUEUE_SIZE = 200
+_mail_queue = queue.Queue(maxsize=_MAIL_QUEUE_SIZE)
+_mailer_lock = threading.Lock()
+_mailer_pid = None
+
+
+def _deliver(app, msg, counselor_message_id=None):
+    """Send one message; record the outcome on its counselor_messages doc"""
+    status = "failed"
+    try:
+        with app.app_context():
+            app.extensions['mail'].send(msg)
+        status = "sent"
+    except Exception as e:
+        app.logger.error(f"Email send error ({msg.subject!r}): {e}")
+
+    if counselor_message_id is not None:
+        try:
+            counselor_messages.update_one(
+                {'_id': counselor_message_id},
+                {'$set': {'email_status': status}}
+            )
+        except Exception as e:
+            app.logger.error(f"Email status update error: {e}")
+
+
+def _drain():
+    while True:
+        job = _mail_queue.get()
+        try:
+            _deliver(*job)
+        finally:
+            _mail_queue.task_done()
+
+
+def _ensure_mailer():
+    """Start the sender on first use so each gunicorn worker gets its own"""
+    global _mailer_pid
+    if _mailer_pid == os.getpid():
+        return
+    with _mailer_lock:
+        if _mailer_pid != os.getpid():
+            threading.Thread(target=_drain, name="mailer", daemon=True).start()
+            _mailer_pid = os.getpid()
+
+
+def mail_configured():
+    """True if Flask-Mail was initialised for the current app"""
+    return current_app.extensions.get('mail') is not None
+
+
+def send_async(msg, counselor_message_id=None):
+    """
+    Queue msg for delivery. Raises RuntimeError if Flask-Mail isn't set
+    up so callers can still report that synchronously. If the queue is
+    backed up the message is sent inline.
+    """
+    app = current_app._get_current_object()
+    if not mail_configured():
+        raise RuntimeError("Flask-Mail is not initialised. "
+                           "Check MAIL_* environment variables.")
+    _ensure_mailer()
+    try:
+        _mail_queue.put_nowait((app, msg, counselor_message_id))
+    except queue.Full:
+        _deliver(app, msg, counselor_message_id)
+
+
+@atexit.register
+def _flush_mail():
+    """Send whatever is still queued when the worker shuts down"""
+    while True:
+        try:
+            job = _mail_queue.get_nowait()
+        except queue.Empty:
+            break
+        _deliver(*job)
@@ -1,11 +1,38 @@
 # User/models.py - User Models with Token Expiration and Password Reset
 import secrets
-import string
+import base64
 import datetime
 import uuid
+import os
 from flask import jsonify, request
-from werkzeug.security import generate_password_hash as gph
-from .database import users, students, password_reset_tokens, logs
+from werkzeug.security import generate_password_hash
+from pymongo.errors import DuplicateKeyError
+from .database import users, students, password_reset_tokens, logs_fast
+from .database import hash_access_token, hash_reset_token, STUDENT_TOKEN_INDEX
+from .database import utcnow
+
+
+# Werkzeug hashes through hashlib.pbkdf2_hmac (OpenSSL), so there is no
+# faster path to hand-roll - just parse the method string in one place.
+# Cost defaults to werkzeug's current 1M. A deployment may only lower it
+# by setting PASSWORD_HASH_ITERATIONS itself (OWASP's floor for
+# PBKDF2-SHA256 is 600k). The iteration count is stored in each hash, so
+# changing it never breaks existing logins.
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS",
+                                         "1000000"))
+PASSWORD_HASH_METHOD = f"pbkdf2:sha256:{PASSWORD_HASH_ITERATIONS}"
+
+TOKEN_LIFETIME = datetime.timedelta(days=7)          # student access token
+RESET_TOKEN_LIFETIME = datetime.timedelta(hours=1)   # password reset link
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def _new_access_token():
+    """8-char A-Z2-7 student token: 40 random bits from one urandom read"""
+    return base64.b32encode(secrets.token_bytes(5)).decode('ascii')
 
 
 class User:
@@ -14,18 +41,16 @@ class User:
     def counselor_signup():
         """Register a new counselor. Returns JSON response with status."""
         try:
-            name = request.form.get('name')
-            email = request.form.get('email')
-            password = request.form.get('password')
-            department = request.form.get('department')
+            form = request.form
+            name = form.get('name')
+            email = form.get('email')
+            password = form.get('password')
+            department = form.get('department')
 
-            if not all([name, email, password, department]):
+            if not all((name, email, password, department)):
                 return jsonify({"error": "All fields are required"}), 400
 
-            if users.find_one({"email": email}):
-                return jsonify({"error": "Email already exists"}), 400
-
-            hashed_password = gph(password, method="pbkdf2")
+            hashed_password = hash_password(password)
 
             counselor_data = {
                 "_id": uuid.uuid4().hex,
@@ -35,10 +60,13 @@ class User:
                 "role": "counselor",
                 "department": department,
                 "status": "active",
-                "created_at": datetime.datetime.utcnow()
+                "created_at": utcnow()
             }
 
-            users.insert_one(counselor_data)
+            try:
+                users.insert_one(counselor_data)
+            except DuplicateKeyError:
+                return jsonify({"error": "Email already exists"}), 400
             return jsonify({"message": "Counselor registered successfully",
                             "data": {"name": name, "email": email}}), 201
 
@@ -46,32 +74,32 @@ class User:
             return jsonify({"error": str(e)}), 500
 
     @staticmethod
-    def student_signup():
-        """Register a new student with 7-day token expiration."""
+    def student_signup(counselor=None):
+        """
+        Register a new student with 7-day token expiration. counselor is an
+        optional {counselor_id, counselor_name} dict stored on the same insert.
+        """
         try:
-            name = request.form.get('name')
-            email = request.form.get('email')
-            parent_name = request.form.get('parent_name')
-            hostel_hall = request.form.get('hall')
-            phone = request.form.get('phone')
-            parent_contact = request.form.get('parent_contact')
-            department = request.form.get('department')
-            gender = request.form.get('gender')
-            matric = request.form.get('matric')
-            room_number = request.form.get('room_number')
-
-            if not all([name, email, parent_name, parent_contact, hostel_hall,
-                        phone, department, matric, room_number]):
+            form = request.form
+            name = form.get('name')
+            email = form.get('email')
+            parent_name = form.get('parent_name')
+            hostel_hall = form.get('hall')
+            phone = form.get('phone')
+            parent_contact = form.get('parent_contact')
+            department = form.get('department')
+            gender = form.get('gender')
+            matric = form.get('matric')
+            room_number = form.get('room_number')
+
+            if not all((name, email, parent_name, parent_contact, hostel_hall,
+                        phone, department, matric, room_number)):
                 return jsonify({"error": "All fields are required"}), 400
 
-            if students.find_one({"email": email}):
-                return jsonify({"error": "Email already exists"}), 400
-
-            alphabet = string.ascii_uppercase + string.digits
-            access_token = ''.join(secrets.choice(alphabet) for _ in range(8))
+            access_token = _new_access_token()
 
-            token_created_at = datetime.datetime.utcnow()
-            token_expires_at = token_created_at + datetime.timedelta(days=7)
+            token_created_at = utcnow()
+            token_expires_at = token_created_at + TOKEN_LIFETIME
 
             student_data = {
                 "_id": uuid.uuid4().hex,
@@ -87,13 +115,23 @@ class User:
                 "role": "student",
                 "gender": gender,
                 "access_token": access_token,
+                "access_token_hash": hash_access_token(access_token),
                 "token_used": False,
                 "token_created_at": token_created_at,
                 "token_expires_at": token_expires_at,
-                "registered_at": datetime.datetime.utcnow()
+                "registered_at": token_created_at
             }
-
-            students.insert_one(student_data)
+            if counselor:
+                student_data.update(counselor)
+
+            try:
+                students.insert_one(student_data)
+            except DuplicateKeyError as e:
+                # access_token_hash is unique too - only email is the
+                # user's fault
+                if "email" not in (e.details or {}).get("keyPattern", {}):
+                    raise
+                return jsonify({"error": "Email already exists"}), 400
             return jsonify({
                 "message": "Student registered successfully",
                 "access_token": access_token,
@@ -109,7 +147,11 @@ class User:
         try:
             email = request.form.get('email')
             password = request.form.get('password')
-            user_record = users.find_one({'email': email})
+            user_record = users.find_one(
+                {'email': email},
+                {'hashed_password': 1, 'status': 1, 'role': 1,
+                 'email': 1, 'name': 1}
+            )
 
             if not user_record:
                 return None, None, None
@@ -129,13 +171,17 @@ class User:
             if not token:
                 return None
 
-            student_record = students.find_one({"access_token": token})
+            student_record = students.find_one(
+                {"access_token_hash": hash_access_token(token)},
+                {"_id": 1, "name": 1, "role": 1, "token_expires_at": 1},
+                hint=STUDENT_TOKEN_INDEX
+            )
 
             if not student_record:
                 return None
 
             token_expires_at = student_record.get('token_expires_at')
-            current_time = datetime.datetime.utcnow()
+            current_time = utcnow()
             if token_expires_at and current_time > token_expires_at:
                 return {"expired": True, "student": student_record}
 
@@ -146,31 +192,40 @@ class User:
             return None
 
     @staticmethod
-    def regenerate_student_token(student_id):
-        """Generate a new access token for a student (7-day expiration)."""
+    def regenerate_student_token(student_id, counselor_id=None):
+        """
+        Generate a new access token for a student (7-day expiration).
+        With counselor_id, only that counselor's student is updated - the
+        ownership check and the write are one round trip.
+        """
         try:
-            alphabet = string.ascii_uppercase + string.digits
-            new_token = ''.join(secrets.choice(alphabet) for _ in range(8))
+            new_token = _new_access_token()
 
-            token_created_at = datetime.datetime.utcnow()
-            token_expires_at = token_created_at + datetime.timedelta(days=7)
+            token_created_at = utcnow()
+            token_expires_at = token_created_at + TOKEN_LIFETIME
 
-            result = students.update_one(
-                {"_id": student_id},
+            query = {"_id": student_id}
+            if counselor_id is not None:
+                query["counselor_id"] = counselor_id
+            student = students.find_one_and_update(
+                query,
                 {
                     "$set": {
                         "access_token": new_token,
+                        "access_token_hash": hash_access_token(new_token),
                         "token_used": False,
                         "token_created_at": token_created_at,
                         "token_expires_at": token_expires_at
                     }
-                }
+                },
+                projection={"name": 1}
             )
 
-            if result.modified_count > 0:
+            if student:
                 return {
                     "token": new_token,
-                    "expires_at": token_expires_at.isoformat()
+                    "expires_at": token_expires_at.isoformat(),
+                    "name": student.get("name")
                 }
 
             return None
@@ -189,10 +244,10 @@ class User:
         Initiate a password reset for a counselor or admin.
 
         - Looks up the user by email.
-        - Invalidates any previous unused tokens for that email so only
-          the newest link works (prevents token accumulation).
+        - Deletes any previous unused tokens for that email so only
+          the newest link works (the TTL index reaps the rest).
         - Generates a cryptographically secure URL-safe token valid for
-          1 hour and stores it in password_reset_tokens.
+          1 hour and stores its hash in password_reset_tokens.
 
         Args:
             email: The email address submitted on the forgot-password form.
@@ -214,23 +269,20 @@ class User:
             if user.get('status') == 'blocked':
                 return None   # blocked accounts cannot reset password
 
-            # Invalidate any existing unused tokens for this email
-            password_reset_tokens.update_many(
-                {'email': email, 'used': False},
-                {'$set': {'used': True}}
-            )
+            # Drop any existing unused tokens for this email - they are
+            # dead either way, so don't leave them for the TTL monitor
+            password_reset_tokens.delete_many({'email': email, 'used': False})
 
             # Generate a 48-byte URL-safe token (64 chars after base64)
             raw_token = secrets.token_urlsafe(48)
-            now = datetime.datetime.utcnow()
+            now = utcnow()
 
             token_doc = {
-                "_id": uuid.uuid4().hex,
                 "user_id": str(user['_id']),
                 "email": email,
-                "token": raw_token,
+                "token_hash": hash_reset_token(raw_token),
                 "created_at": now,
-                "expires_at": now + datetime.timedelta(hours=1),
+                "expires_at": now + RESET_TOKEN_LIFETIME,
                 "used": False
             }
 
@@ -259,13 +311,14 @@ class User:
             token document (dict) if valid, None otherwise.
         """
         try:
-            now = datetime.datetime.utcnow()
-            token_doc = password_reset_tokens.find_one({
-                'token': token,
-                'used': False,
-                'expires_at': {'$gt': now}
-            })
-            return token_doc
+            # Not cached: one indexed find_one, and a per-worker cache
+            # would keep showing the form for a link already used or
+            # replaced in another worker
+            return password_reset_tokens.find_one(
+                {'token_hash': hash_reset_token(token), 'used': False,
+                 'expires_at': {'$gt': utcnow()}},
+                {'user_id': 1, 'email': 1, 'expires_at': 1}
+            )
 
         except Exception as e:
             print(f"verify_reset_token error: {e}")
@@ -277,11 +330,11 @@ class User:
         Consume a reset token and update the user's password.
 
         Steps:
-          1. Find a valid (unused, unexpired) token document.
-          2. Find the corresponding user.
-          3. Hash and set the new password.
-          4. Mark the token as used so it cannot be replayed.
-          5. Log the password-reset event in activity_logs.
+          1. Atomically claim a valid (unused, unexpired) token, marking
+             it used so it cannot be replayed.
+          2. Hash and set the new password on the token's user - only
+             after a successful claim, so a bogus token costs no PBKDF2.
+          3. Log the password-reset event in activity_logs.
 
         Args:
             token:        The raw token string from the URL.
@@ -292,47 +345,35 @@ class User:
         """
         try:
 
-            now = datetime.datetime.utcnow()
+            now = utcnow()
 
-            # 1. Find valid token
-            token_doc = password_reset_tokens.find_one({
-                'token': token,
-                'used': False,
-                'expires_at': {'$gt': now}
-            })
+            # 1. Claim the token - two concurrent submits can't both win
+            token_doc = password_reset_tokens.find_one_and_update(
+                {'token_hash': hash_reset_token(token), 'used': False,
+                 'expires_at': {'$gt': now}},
+                {'$set': {'used': True, 'used_at': now}},
+                projection={'user_id': 1, 'email': 1}
+            )
 
             if not token_doc:
                 return False
 
             user_id = token_doc['user_id']
 
-            # 2. Find user
-            user = users.find_one({'_id': user_id})
-            if not user:
-                return False
-
-            # 3. Hash new password and update
-            new_hash = gph(new_password, method='pbkdf2')
+            # 2. Set the new password
             result = users.update_one(
                 {'_id': user_id},
                 {'$set': {
-                    'hashed_password': new_hash,
+                    'hashed_password': hash_password(new_password),
                     'password_updated_at': now
                 }}
             )
 
-            if result.modified_count == 0:
+            if result.matched_count == 0:
                 return False
 
-            # 4. Mark token consumed
-            password_reset_tokens.update_one(
-                {'_id': token_doc['_id']},
-                {'$set': {'used': True, 'used_at': now}}
-            )
-
-            # 5. Audit log
-            logs.insert_one({
-                '_id': uuid.uuid4().hex,
+            # 3. Audit log
+            logs_fast.insert_one({
                 'user_id': user_id,
                 'action': 'password_reset_via_email',
                 'email': token_doc['email'],
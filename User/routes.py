@@ -1,21 +1,75 @@
 # User/routes.py - Application Routes
-import uuid
 import datetime
 import os
+import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from flask import render_template, request, redirect, url_for, flash
 from flask import session, Blueprint, jsonify, current_app
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.security import check_password_hash
 from flask_mail import Message, Mail
-from .models import User
+from .models import User, hash_password
+from .mailer import send_async, mail_configured
+from .cache import TTLCache
 from .database import users, students, messages, flags, counselor_messages
-from .database import logs
+from .database import logs_fast, users_fast, FLAG_COUNSELOR_INDEX
+from .database import utcnow, bounded_count
 from .auth import role_required, login_required, student_required
-from .chat import send_message
+from .auth import current_user
+from .chat import send_message, notifications_cache
 
 
 routes = Blueprint('IMHSS', __name__, template_folder='templates',
                    static_folder='static')
 
+# Mail sender identity, read once from .env.
+# CRITICAL: sender email MUST be the same as MAIL_USERNAME
+# (the authenticated Gmail account). Gmail rejects mail sent
+# "from" a different domain than the authenticated account.
+_MAIL_USERNAME = os.getenv('MAIL_USERNAME')
+_NOREPLY_NAME = os.getenv('NOREPLY_NAME', 'IMHMS Support')
+# Always use the authenticated Gmail as the actual sender address
+_NOREPLY_EMAIL = os.getenv('NOREPLY_EMAIL', _MAIL_USERNAME)
+
+# Plain-text mail bodies. Filled with str.format, which never re-parses
+# the substituted values, so braces in a counselor's message are safe.
+_RESET_MAIL_BODY = (
+    "Hi {name},\n\n"
+    "We received a request to reset your IMHMS password.\n\n"
+    "Click the link below to set a new password.\n"
+    "This link expires in 1 hour.\n\n"
+    "{url}\n\n"
+    "If you did not request a password reset, please ignore "
+    "this email.\n\n"
+    "---\n"
+    "IMHMS – Integrated Mental Health Monitoring System\n"
+    "Do not reply to this email."
+)
+
+_COUNSELOR_MAIL_BODY = (
+    "Dear {student_name},\n\n"
+    "{body}\n\n"
+    "---\n"
+    "This is an automated system message from your counselor, "
+    "{counselor_name}.\n"
+    "This mailbox is not monitored. Please contact your counselor "
+    "directly.\n\n"
+    "IMHMS support team"
+)
+
+# bounded_count() caps: the notification badge shows "99+", and chat
+# history reports at most "1000+" messages
+_NOTIFICATION_COUNT_CAP = 100
+_HISTORY_COUNT_CAP = 1000
+
+# Largest chat-history page a client may ask for
+_HISTORY_MAX_PER_PAGE = 200
+
+# Independent dashboard reads run side by side - PyMongo releases the GIL
+# while it waits on the network. Threads start on first submit, so each
+# gunicorn worker gets its own.
+_query_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="query")
+
 
 # ══════════════════════════════════════════════════════════════
 # TIMEZONE CONVERSION FILTER
@@ -29,6 +83,22 @@ def local_time_filter(utc_dt):
     return utc_dt + datetime.timedelta(hours=1)
 
 
+def _revalidate(response, etag):
+    """
+    Private + revalidate every time: the browser keeps a copy but must
+    send If-None-Match before using it
+    """
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _first_error(checks):
+    """First message in a [(failed, message), ...] table, or None"""
+    return next((message for failed, message in checks if failed), None)
+
+
 # --------------------------------------------------
 # Landing Page
 # --------------------------------------------------
@@ -58,24 +128,25 @@ def counselor_login():
             flash("Your account has been blocked. Contact admin.", "error")
             return redirect(url_for('.counselor_login'))
 
-        timestamp = datetime.datetime.utcnow()
-        users.update_one(
-            {'email': email},
-            {'$set': {"last_login": timestamp}}
+        users_fast.update_one(
+            {'_id': counselor_record['_id']},
+            {'$set': {"last_login": utcnow()}}
         )
 
+        role = counselor_record.get("role")
         session.clear()
-        session["user_id"] = str(counselor_record["_id"])
-        session["role"] = counselor_record.get("role")
-        session["email"] = counselor_record.get("email")
-        session["name"] = counselor_record.get("name")
-        session["timestamp"] = timestamp.isoformat()
+        session.update({
+            "user_id": str(counselor_record["_id"]),
+            "role": role,
+            "email": counselor_record.get("email"),
+            "name": counselor_record.get("name"),
+        })
 
-        if counselor_record.get("role") == "admin":
+        if role == "admin":
             flash("Login successful", "success")
             return redirect(url_for('.admin_dashboard'))
 
-        if counselor_record.get("role") == "counselor":
+        if role == "counselor":
             flash("Login successful", "success")
             return redirect(url_for('.counselor_dashboard'))
 
@@ -137,41 +208,15 @@ def forgot_password():
         )
 
         try:
-            mail = current_app.extensions.get('mail')
-            if mail is None:
-                raise RuntimeError(
-                    "Flask-Mail is not initialised. "
-                    "Check MAIL_* environment variables."
-                )
-
-            # Read sender identity from .env.
-            # CRITICAL: sender email MUST be the same as MAIL_USERNAME
-            # (the authenticated Gmail account). Gmail rejects mail sent
-            # "from" a different domain than the authenticated account.
-            mail_username = os.getenv('MAIL_USERNAME')
-            noreply_name = os.getenv('NOREPLY_NAME', 'IMHMS Support')
-            # Always use the authenticated Gmail as the actual sender address
-            noreply_email = os.getenv('NOREPLY_EMAIL', mail_username)
-
             msg = Message(
                 subject="Reset your IMHMS password",
                 recipients=[result['user_email']],
-                sender=(noreply_name, noreply_email),
+                sender=(_NOREPLY_NAME, _NOREPLY_EMAIL),
                 reply_to=None   # no-reply: suppress reply-to header
             )
-            msg.body = (
-                f"Hi {result['user_name']},\n\n"
-                f"We received a request to reset your IMHMS password.\n\n"
-                f"Click the link below to set a new password.\n"
-                f"This link expires in 1 hour.\n\n"
-                f"{reset_url}\n\n"
-                f"If you did not request a password reset, please ignore "
-                f"this email.\n\n"
-                f"---\n"
-                f"IMHMS – Integrated Mental Health Monitoring System\n"
-                f"Do not reply to this email."
-            )
-            mail.send(msg)
+            msg.body = _RESET_MAIL_BODY.format(
+                name=result['user_name'], url=reset_url)
+            send_async(msg)
 
             flash(
                 f"A password reset link has been sent to {email}. "
@@ -276,45 +321,64 @@ def logout():
 # --------------------------------------------------
 # Admin Routes
 # --------------------------------------------------
+# Stat-card counts the listings don't already give us. Per worker, so
+# writes in this process clear it and other workers catch up within ttl.
+_admin_counts_cache = TTLCache(ttl=30, maxsize=1)
+
+
+def _admin_counts():
+    counts = _admin_counts_cache.get('counts')
+    if counts is None:
+        futures = {
+            'active_users': _query_pool.submit(
+                users.count_documents, {'status': 'active'}),
+            'total_messages': _query_pool.submit(
+                messages.estimated_document_count),
+            'flagged_count': _query_pool.submit(
+                flags.count_documents, {'reviewed': False}),
+        }
+        counts = {name: f.result() for name, f in futures.items()}
+        _admin_counts_cache.set('counts', counts)
+    return counts
+
+
 @routes.route('/admin/dashboard')
 @login_required
 @role_required("admin")
 def admin_dashboard():
-    counselor_count = users.count_documents({'role': 'counselor'})
-    student_count = students.count_documents({})
-    active_users = users.count_documents({'status': 'active'})
-
-    counselors = list(users.find(
+    counselors_f = _query_pool.submit(lambda: list(users.find(
         {'role': 'counselor'},
         {'name': 1, 'email': 1, 'department': 1, 'status': 1}
-    ))
-
-    all_students = list(students.find(
+    )))
+    students_f = _query_pool.submit(lambda: list(students.find(
         {},
         {'name': 1, 'email': 1, 'matric': 1, 'department': 1,
          'counselor_id': 1, 'token_expires_at': 1, 'token_used': 1,
          'last_login': 1, 'counselor_name': 1, 'access_token': 1}
-    ))
-
+    )))
+    counts = _admin_counts()
+    counselors = counselors_f.result()
+    all_students = students_f.result()
+
+    # Every student (with counselor_id) is already loaded above - count
+    # them here instead of one count_documents per counselor
+    students_per_counselor = Counter(s.get('counselor_id') for s in all_students)
     counselor_student_counts = {}
     for counselor in counselors:
         counselor_id = str(counselor['_id'])
-        count = students.count_documents({'counselor_id': counselor_id})
+        count = students_per_counselor[counselor_id]
         counselor_student_counts[counselor_id] = count
-        counselor["capacity_percent"] = int((count / 5) * 100)
-
-    total_messages = messages.estimated_document_count()
-    flagged_count = flags.count_documents({'reviewed': False})
+        counselor["capacity_percent"] = count * 20   # 5 students = 100%
 
     return render_template('admin.html',
-                           counselor_count=counselor_count,
-                           student_count=student_count,
-                           active_users=active_users,
+                           counselor_count=len(counselors),
+                           student_count=len(all_students),
+                           active_users=counts['active_users'],
                            counselors=counselors,
                            counselor_student_counts=counselor_student_counts,
                            students=all_students,
-                           total_messages=total_messages,
-                           flagged_count=flagged_count)
+                           total_messages=counts['total_messages'],
+                           flagged_count=counts['flagged_count'])
 
 
 # --------------------------------------------------
@@ -328,6 +392,7 @@ def admin_create_counselor():
         response, status_code = User.counselor_signup()
 
         if status_code == 201:
+            _admin_counts_cache.clear()
             flash("Counselor registered successfully", "success")
             return redirect(url_for('.admin_dashboard'))
         else:
@@ -347,7 +412,8 @@ def admin_toggle_user_status():
         return redirect(url_for('.counselor_login'))
 
     user_id = request.form.get('user_id')
-    user = users.find_one({'_id': user_id})
+    user = users.find_one({'_id': user_id},
+                          {'name': 1, 'role': 1, 'status': 1})
 
     if not user:
         flash("User not found", "error")
@@ -359,6 +425,7 @@ def admin_toggle_user_status():
 
     new_status = 'blocked' if user.get('status') == 'active' else 'active'
     users.update_one({'_id': user_id}, {'$set': {'status': new_status}})
+    _admin_counts_cache.clear()
 
     flash(f"User {user['name']} has been {new_status}", "success")
     return redirect(url_for('.admin_dashboard'))
@@ -383,134 +450,173 @@ def admin_view_all_messages():
 @login_required
 @role_required("admin")
 def admin_view_all_flags():
-    page = request.args.get('page', 1, type=int)
     per_page = 50
 
-    skip = (page - 1) * per_page
-    all_flags = list(flags.find().sort('flagged_at', -1)
-                     .skip(skip).limit(per_page))
-
-    student_ids = list(set([f['student_id'] for f in all_flags]))
-    message_ids = list(set([f['message_id'] for f in all_flags]))
-    counselor_ids = list(set([f['counselor_id'] for f in all_flags]))
-
-    student_map = {s['_id']: s for s in students.find(
-        {'_id': {'$in': student_ids}})}
-    message_map = {m['_id']: m for m in messages.find(
-        {'_id': {'$in': message_ids}})}
-    counselor_map = {u['_id']: u for u in users.find(
-        {'_id': {'$in': counselor_ids}})}
+    # Keyset pagination: ?before=<flagged_at iso>&before_id=<flag _id> of
+    # the last flag on the previous page. No skip, no count.
+    query = {}
+    before = request.args.get('before', '')
+    before_id = request.args.get('before_id', '')
+    if before and before_id:
+        try:
+            before_at = datetime.datetime.fromisoformat(before)
+        except ValueError:
+            return redirect(url_for('.admin_view_all_flags'))
+        query = {'$or': [
+            {'flagged_at': {'$lt': before_at}},
+            {'flagged_at': before_at, '_id': {'$lt': before_id}},
+        ]}
+
+    all_flags = list(flags.find(query)
+                     .sort([('flagged_at', -1), ('_id', -1)])
+                     .limit(per_page + 1))
+    has_more = len(all_flags) > per_page
+    del all_flags[per_page:]
+
+    # Only what admin_flags.html shows; an empty page needs no lookups
+    if all_flags:
+        student_ids = list({f['student_id'] for f in all_flags})
+        message_ids = list({f['message_id'] for f in all_flags})
+        counselor_ids = list({f['counselor_id'] for f in all_flags})
+
+        lookups = [
+            _query_pool.submit(lambda: {s['_id']: s for s in students.find(
+                {'_id': {'$in': student_ids}}, {'name': 1})}),
+            _query_pool.submit(lambda: {m['_id']: m for m in messages.find(
+                {'_id': {'$in': message_ids}},
+                {'content': 1, 'ai_response': 1})}),
+            _query_pool.submit(lambda: {u['_id']: u for u in users.find(
+                {'_id': {'$in': counselor_ids}}, {'name': 1})}),
+        ]
+        student_map, message_map, counselor_map = (
+            f.result() for f in lookups)
+    else:
+        student_map = message_map = counselor_map = {}
 
     for flag in all_flags:
         flag['student'] = student_map.get(flag['student_id'])
         flag['message'] = message_map.get(flag['message_id'])
         flag['counselor'] = counselor_map.get(flag['counselor_id'])
 
-    total = flags.estimated_document_count()
+    next_page = None
+    if has_more:
+        last = all_flags[-1]
+        next_page = url_for('.admin_view_all_flags',
+                            before=last['flagged_at'].isoformat(),
+                            before_id=last['_id'])
 
     return render_template('admin_flags.html',
                            flags=all_flags,
-                           page=page,
-                           total_pages=(total + per_page - 1) // per_page)
+                           next_page=next_page)
 
 
 # --------------------------------------------------
 # Counselor Routes
 # --------------------------------------------------
+def _dashboard_flags(counselor_id):
+    """Newest unreviewed high and medium flags, 20 of each, enriched"""
+    # Show ONLY unreviewed flags (reviewed ones are cleared). One round
+    # trip: walk the index newest-first, then keep the latest 20 of each
+    # level - a plain limit(40) could starve one level.
+    # The student name and message text are joined in on the server, after
+    # the limit, so each lookup runs at most 40 times.
+    enrich = [
+        {'$lookup': {'from': students.name, 'localField': 'student_id',
+                     'foreignField': '_id', 'as': 'student',
+                     'pipeline': [{'$project': {'name': 1}}]}},
+        {'$lookup': {'from': messages.name, 'localField': 'message_id',
+                     'foreignField': '_id', 'as': 'message',
+                     'pipeline': [{'$project': {'content': 1,
+                                                'ai_response': 1}}]}},
+        {'$set': {'student': {'$first': '$student'},
+                  'message': {'$first': '$message'}}},
+    ]
+    return next(flags.aggregate([
+        {'$match': {'counselor_id': counselor_id, 'reviewed': False,
+                    'risk_level': {'$in': ['high', 'medium']}}},
+        {'$sort': {'flagged_at': -1}},
+        {'$facet': {
+            'high': [{'$match': {'risk_level': 'high'}}, {'$limit': 20},
+                     *enrich],
+            'medium': [{'$match': {'risk_level': 'medium'}}, {'$limit': 20},
+                       *enrich],
+        }},
+    ], hint=FLAG_COUNSELOR_INDEX))
+
+
+def _messageable_students(counselor_id):
+    """The counselor's students who have at least one flag"""
+    flagged_student_ids = flags.distinct('student_id',
+                                         {'counselor_id': counselor_id})
+    return list(students.find(
+        {'_id': {'$in': flagged_student_ids},
+         'counselor_id': counselor_id},
+        {'name': 1, 'email': 1}
+    ))
+
+
 @routes.route('/counselor/dashboard')
 @login_required
 @role_required("counselor")
 def counselor_dashboard():
     counselor_id = session.get('user_id')
-    now = datetime.datetime.utcnow()
-
-    my_students = list(students.find(
-        {'counselor_id': counselor_id},
-        {
+    now = utcnow()
+
+    # Everything else is independent of the student list - start those
+    # reads first
+    flags_f = _query_pool.submit(_dashboard_flags, counselor_id)
+    unreviewed_f = _query_pool.submit(
+        flags.count_documents,
+        {'counselor_id': counselor_id, 'reviewed': False},
+        hint=FLAG_COUNSELOR_INDEX)
+    messageable_f = _query_pool.submit(_messageable_students, counselor_id)
+    sent_f = _query_pool.submit(lambda: list(counselor_messages.find(
+        {'counselor_id': counselor_id}
+    ).sort('sent_at', -1).limit(50)))
+
+    # token_expired / days_until_expiry are worked out by the server.
+    # days_until_expiry matches timedelta.days (floor of whole days left);
+    # a missing expiry becomes null, which sorts below any date, so it
+    # reads as expired with 0 days left. message_count is counted on the
+    # (student_id, timestamp) index in the same round trip.
+    expires = {'$ifNull': ['$token_expires_at', None]}
+    my_students = list(students.aggregate([
+        {'$match': {'counselor_id': counselor_id}},
+        {'$project': {
             'name': 1, 'email': 1, 'phone': 1, 'matric': 1, 'department': 1,
             'token_expires_at': 1, 'access_token': 1, 'token_used': 1,
             'parent_contact': 1, 'hostel_hall': 1, 'gender': 1,
             'room_number': 1
-        }
-    ))
-
-    for student in my_students:
-        token_expires_at = student.get('token_expires_at')
-        if token_expires_at:
-            student['token_expired'] = now > token_expires_at
-            student['days_until_expiry'] = (
-                (token_expires_at - now).days
-                if now < token_expires_at else 0
-            )
-        else:
-            student['token_expired'] = True
-            student['days_until_expiry'] = 0
+        }},
+        {'$addFields': {
+            'token_expired': {'$lt': [expires, now]},
+            'days_until_expiry': {'$cond': [
+                {'$gt': [expires, now]},
+                {'$toInt': {'$floor': {'$divide': [
+                    {'$subtract': ['$token_expires_at', now]}, 86400000]}}},
+                0
+            ]},
+        }},
+        {'$lookup': {'from': messages.name, 'localField': '_id',
+                     'foreignField': 'student_id', 'as': 'message_count',
+                     'pipeline': [{'$count': 'n'}]}},
+        {'$set': {'message_count': {'$ifNull': [
+            {'$first': '$message_count.n'}, 0]}}},
+    ]))
 
     my_students_count = len(my_students)
-    student_ids = [s['_id'] for s in my_students]
-
-    total_messages_count = messages.count_documents(
-        {'student_id': {'$in': student_ids}})
-
-    # Show ONLY unreviewed flags (reviewed ones are cleared)
-    high_risk_flags = list(flags.find({
-        'counselor_id': counselor_id,
-        'risk_level': 'high',
-        'reviewed': False
-    }).sort('flagged_at', -1).limit(20))
-
-    medium_risk_flags = list(flags.find({
-        'counselor_id': counselor_id,
-        'risk_level': 'medium',
-        'reviewed': False
-    }).sort('flagged_at', -1).limit(20))
-
-    # Count only UNREVIEWED flags for stat card
-    unreviewed_count = flags.count_documents({
-        'counselor_id': counselor_id,
-        'reviewed': False
-    })
-
-    flag_student_ids = list(
-        set([f['student_id'] for f in high_risk_flags + medium_risk_flags]))
-    flag_message_ids = list(
-        set([f['message_id'] for f in high_risk_flags + medium_risk_flags]))
-
-    flag_students = {s['_id']: s for s in students.find(
-        {'_id': {'$in': flag_student_ids}})}
-    flag_messages = {m['_id']: m for m in messages.find(
-        {'_id': {'$in': flag_message_ids}})}
+    total_messages_count = sum(s['message_count'] for s in my_students)
 
-    for flag in high_risk_flags + medium_risk_flags:
-        flag['student'] = flag_students.get(flag['student_id'])
-        flag['message'] = flag_messages.get(flag['message_id'])
-
-    flagged_student_ids = list(set(
-        [f['student_id'] for f in
-         list(flags.find({'counselor_id': counselor_id},
-                         {'student_id': 1}))]
-    ))
-    messageable_students = list(students.find(
-        {'_id': {'$in': flagged_student_ids},
-         'counselor_id': counselor_id},
-        {'name': 1, 'email': 1}
-    ))
-
-    sent_messages = list(counselor_messages.find(
-        {'counselor_id': counselor_id}
-    ).sort('sent_at', -1).limit(50))
+    risk_flags = flags_f.result()
+    high_risk_flags = risk_flags['high']
+    medium_risk_flags = risk_flags['medium']
+    unreviewed_count = unreviewed_f.result()   # stat card: unreviewed only
+    messageable_students = messageable_f.result()
+    sent_messages = sent_f.result()
 
     # Check if counselor can register more students (max 5)
     can_register_student = my_students_count < 5
 
-    # Debug: Log flag counts
-    print(f'[DEBUG] Counselor {counselor_id} dashboard:')
-    print(f'  - high_risk_flags: {len(high_risk_flags)}')
-    print(f'  - medium_risk_flags: {len(medium_risk_flags)}')
-    print(f'  - unreviewed_count: {unreviewed_count}')
-    if high_risk_flags:
-        print(f'  - First high-risk flag: {high_risk_flags[0].get("student_id", "No ID")}')
-
     return render_template('counselor.html',
                            my_students_count=my_students_count,
                            my_students=my_students,
@@ -531,7 +637,7 @@ def counselor_dashboard():
 @role_required("counselor")
 def counselor_create_student():
     counselor_id = session.get('user_id')
-    counselor_record = users.find_one({'_id': counselor_id}, {'name': 1})
+    counselor_record = current_user()
 
     if not counselor_record:
         flash("Counselor not found", "error")
@@ -540,18 +646,13 @@ def counselor_create_student():
     counselor_name = counselor_record.get('name')
 
     if request.method == 'POST':
-        response, status_code = User.student_signup()
+        response, status_code = User.student_signup(
+            {'counselor_id': counselor_id, 'counselor_name': counselor_name})
 
         if status_code == 201:
             data = response.get_json()
             access_token = data.get('access_token')
 
-            students.update_one(
-                {'access_token': access_token},
-                {'$set': {'counselor_id': counselor_id,
-                          'counselor_name': counselor_name}}
-            )
-
             flash(
                 f"Student registered! Token: {access_token} "
                 f"(Expires in 7 days)",
@@ -573,25 +674,17 @@ def counselor_create_student():
 def counselor_regenerate_token(student_id):
     counselor_id = session.get('user_id')
 
-    student = students.find_one({
-        '_id': student_id,
-        'counselor_id': counselor_id
-    }, {'name': 1, 'email': 1})
-
-    if not student:
-        flash("Student not found or not assigned to you", "error")
-        return redirect(url_for('.counselor_dashboard'))
-
-    result = User.regenerate_student_token(student_id)
+    result = User.regenerate_student_token(student_id, counselor_id)
 
     if result:
         flash(
-            f"New token generated for {student['name']}: "
+            f"New token generated for {result['name']}: "
             f"{result['token']} (Valid for 7 days)",
             "success"
         )
     else:
-        flash("Failed to regenerate token", "error")
+        flash("Failed to regenerate token - student not found or not "
+              "assigned to you", "error")
 
     return redirect(url_for('.counselor_dashboard'))
 
@@ -604,7 +697,6 @@ def counselor_regenerate_token(student_id):
 @role_required("counselor")
 def counselor_view_student_messages(student_id):
     counselor_id = session.get('user_id')
-    page = request.args.get('page', 1, type=int)
     per_page = 50
 
     student = students.find_one({
@@ -616,16 +708,36 @@ def counselor_view_student_messages(student_id):
         flash("Student not found or not assigned to you", "error")
         return redirect(url_for('.counselor_dashboard'))
 
-    skip = (page - 1) * per_page
-    student_flags = list(flags.find({
-        'student_id': student_id,
-        'counselor_id': counselor_id
-    }).sort('flagged_at', -1).skip(skip).limit(per_page))
-
-    message_ids = [f['message_id'] for f in student_flags]
-    message_map = {
-        m['_id']: m for m in messages.find({'_id': {'$in': message_ids}})
-    }
+    # Keyset pagination as in admin_view_all_flags; one flag past the
+    # page tells us whether there is a next page - no separate count
+    query = {'student_id': student_id, 'counselor_id': counselor_id}
+    before = request.args.get('before', '')
+    before_id = request.args.get('before_id', '')
+    if before and before_id:
+        try:
+            before_at = datetime.datetime.fromisoformat(before)
+        except ValueError:
+            return redirect(url_for('.counselor_view_student_messages',
+                                    student_id=student_id))
+        query['$or'] = [
+            {'flagged_at': {'$lt': before_at}},
+            {'flagged_at': before_at, '_id': {'$lt': before_id}},
+        ]
+
+    student_flags = list(flags.find(query)
+                         .sort([('flagged_at', -1), ('_id', -1)])
+                         .limit(per_page + 1))
+    has_next = len(student_flags) > per_page
+    del student_flags[per_page:]
+
+    message_map = {}
+    if student_flags:
+        message_ids = [f['message_id'] for f in student_flags]
+        message_map = {
+            m['_id']: m for m in messages.find(
+                {'_id': {'$in': message_ids}},
+                {'content': 1, 'ai_response': 1, 'timestamp': 1})
+        }
 
     # Build enriched message objects for the template
     enriched_messages = []
@@ -640,20 +752,21 @@ def counselor_view_student_messages(student_id):
                 'risk_level': flag.get('risk_level', 'high')
             })
 
-    total_flags = flags.count_documents({
-        'student_id': student_id,
-        'counselor_id': counselor_id
-    })
-
     flagged_count = len(enriched_messages)
 
+    next_page = None
+    if has_next:
+        last = student_flags[-1]
+        next_page = url_for('.counselor_view_student_messages',
+                            student_id=student_id,
+                            before=last['flagged_at'].isoformat(),
+                            before_id=last['_id'])
+
     return render_template('counselor_student_messages.html',
                            student=student,
                            messages=enriched_messages,
                            flagged_count=flagged_count,
-                           page=page,
-                           total_pages=(total_flags + per_page - 1)
-                           // per_page)
+                           next_page=next_page)
 
 
 # --------------------------------------------------
@@ -666,12 +779,14 @@ def counselor_review_flag(flag_id):
     counselor_id = session.get('user_id')
     notes = request.form.get('notes', '')
 
+    # Only an unreviewed flag matches, so a resubmitted form can't
+    # overwrite the first review's timestamp and notes
     result = flags.update_one(
-        {'_id': flag_id, 'counselor_id': counselor_id},
+        {'_id': flag_id, 'counselor_id': counselor_id, 'reviewed': False},
         {
             '$set': {
                 'reviewed': True,
-                'reviewed_at': datetime.datetime.utcnow(),
+                'reviewed_at': utcnow(),
                 'reviewed_by': counselor_id,
                 'notes': notes
             }
@@ -679,9 +794,10 @@ def counselor_review_flag(flag_id):
     )
 
     if result.modified_count > 0:
+        notifications_cache.pop(counselor_id)
         flash("Flag marked as reviewed", "success")
     else:
-        flash("Flag not found", "error")
+        flash("Flag not found or already reviewed", "error")
 
     return redirect(url_for('.counselor_dashboard'))
 
@@ -702,24 +818,15 @@ def counselor_send_message():
     subject = request.form.get('subject', '').strip()
     body = request.form.get('body', '').strip()
 
-    if not student_id:
-        flash("Please select a student.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#messages')
-
-    if not subject:
-        flash("Subject cannot be empty.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#messages')
-
-    if not body:
-        flash("Message body cannot be empty.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#messages')
-
-    if len(subject) > 200:
-        flash("Subject must be 200 characters or fewer.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#messages')
-
-    if len(body) > 4000:
-        flash("Message body must be 4,000 characters or fewer.", "error")
+    error = _first_error((
+        (not student_id, "Please select a student."),
+        (not subject, "Subject cannot be empty."),
+        (not body, "Message body cannot be empty."),
+        (len(subject) > 200, "Subject must be 200 characters or fewer."),
+        (len(body) > 4000, "Message body must be 4,000 characters or fewer."),
+    ))
+    if error:
+        flash(error, "error")
         return redirect(url_for('.counselor_dashboard') + '#messages')
 
     student = students.find_one({
@@ -747,43 +854,18 @@ def counselor_send_message():
         flash("This student has no email address on record.", "error")
         return redirect(url_for('.counselor_dashboard') + '#messages')
 
-    email_status = "failed"
-    try:
-        mail = current_app.extensions.get('mail')
-        if mail is None:
-            raise RuntimeError("Flask-Mail is not initialised.")
-
-        mail_username = os.getenv('MAIL_USERNAME')
-        noreply_name = os.getenv('NOREPLY_NAME', 'IMHMS Support')
-
-        msg = Message(
-            subject=subject,
-            recipients=[student_email],
-            sender=(noreply_name, mail_username)
-        )
-        msg.body = (
-            f"Dear {student_name},\n\n"
-            f"{body}\n\n"
-            f"---\n"
-            f"This is an automated system message from your counselor, "
-            f"{counselor_name}.\n"
-            f"This mailbox is not monitored. Please contact your counselor "
-            f"directly.\n\n"
-            f"IMHMS support team"
-        )
-        mail.send(msg)
-        email_status = "sent"
-
-    except Exception as e:
-        current_app.logger.error(f"Email send error: {e}")
-        flash(
-            "Message saved but could not be delivered by email. "
-            "Please check your mail server settings.",
-            "warning"
-        )
+    msg = Message(
+        subject=subject,
+        recipients=[student_email],
+        sender=(_NOREPLY_NAME, _MAIL_USERNAME)
+    )
+    msg.body = _COUNSELOR_MAIL_BODY.format(
+        student_name=student_name, body=body, counselor_name=counselor_name)
 
-    counselor_messages.insert_one({
-        "_id": str(uuid.uuid4()),
+    # Saved as "queued" first; the mailer thread flips it to sent/failed.
+    # Without a mail server it is stored as failed straight away.
+    mail_ready = mail_configured()
+    result = counselor_messages.insert_one({
         "counselor_id":    counselor_id,
         "counselor_name":  counselor_name,
         "counselor_email": counselor_email,
@@ -792,12 +874,30 @@ def counselor_send_message():
         "student_email":   student_email,
         "subject":         subject,
         "body":            body,
-        "sent_at":         datetime.datetime.utcnow(),
-        "email_status":    email_status
+        "sent_at":         utcnow(),
+        "email_status":    "queued" if mail_ready else "failed"
     })
 
-    if email_status == "sent":
-        flash(f"Message sent successfully to {student_name}.", "success")
+    if mail_ready:
+        try:
+            send_async(msg, counselor_message_id=result.inserted_id)
+            flash(f"Message sent successfully to {student_name}.", "success")
+            return redirect(url_for('.counselor_dashboard') + '#messages')
+        except Exception as e:
+            current_app.logger.error(f"Email send error: {e}")
+            counselor_messages.update_one(
+                {'_id': result.inserted_id},
+                {'$set': {'email_status': "failed"}}
+            )
+    else:
+        current_app.logger.error("Email send error: Flask-Mail is not "
+                                 "initialised")
+
+    flash(
+        "Message saved but could not be delivered by email. "
+        "Please check your mail server settings.",
+        "warning"
+    )
 
     return redirect(url_for('.counselor_dashboard') + '#messages')
 
@@ -815,31 +915,21 @@ def change_password():
     new_password = request.form.get('new_password', '').strip()
     confirm_password = request.form.get('confirm_password', '').strip()
 
-    if not current_password:
-        flash("Please enter your current password.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#password')
-
-    if not new_password:
-        flash("Please enter a new password.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#password')
-
-    if not confirm_password:
-        flash("Please confirm your new password.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#password')
-
-    if len(new_password) < 8:
-        flash("New password must be at least 8 characters long.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#password')
-
-    if new_password != confirm_password:
-        flash("New passwords do not match.", "error")
-        return redirect(url_for('.counselor_dashboard') + '#password')
-
-    if current_password == new_password:
-        flash("New password must be different from current password.", "error")
+    error = _first_error((
+        (not current_password, "Please enter your current password."),
+        (not new_password, "Please enter a new password."),
+        (not confirm_password, "Please confirm your new password."),
+        (len(new_password) < 8,
+         "New password must be at least 8 characters long."),
+        (new_password != confirm_password, "New passwords do not match."),
+        (current_password == new_password,
+         "New password must be different from current password."),
+    ))
+    if error:
+        flash(error, "error")
         return redirect(url_for('.counselor_dashboard') + '#password')
 
-    counselor = users.find_one({'_id': counselor_id})
+    counselor = current_user()
 
     if not counselor:
         flash("Counselor not found.", "error")
@@ -850,25 +940,24 @@ def change_password():
         return redirect(url_for('.counselor_dashboard') + '#password')
 
     try:
-        new_hashed_password = generate_password_hash(new_password,
-                                                     method='pbkdf2')
+        new_hashed_password = hash_password(new_password)
+        now = utcnow()
         result = users.update_one(
             {'_id': counselor_id},
             {
                 '$set': {
                     'hashed_password':    new_hashed_password,
-                    'password_updated_at': datetime.datetime.utcnow()
+                    'password_updated_at': now
                 }
             }
         )
 
         if result.modified_count > 0:
             flash("Password changed successfully!", "success")
-            logs.insert_one({
-                '_id':        str(uuid.uuid4()),
+            logs_fast.insert_one({
                 'user_id':    counselor_id,
                 'action':     'password_changed',
-                'timestamp':  datetime.datetime.utcnow(),
+                'timestamp':  now,
                 'ip_address': request.remote_addr,
                 'user_agent': request.headers.get('User-Agent')
             })
@@ -903,18 +992,21 @@ def student_login():
             return redirect(url_for('.student_login'))
 
         student_record = result
-        timestamp = datetime.datetime.utcnow()
+        timestamp = utcnow()
 
         students.update_one(
-            {'access_token': student_record['access_token']},
+            {'_id': student_record['_id']},
             {'$set': {"token_used": True, "last_login": timestamp}}
         )
 
+        name = student_record.get("name")
         session.clear()
-        session["student_id"] = str(student_record["_id"])
-        session["role"] = student_record.get("role")
-        session["student_name"] = student_record.get("name")
-        session["name"] = student_record.get("name")
+        session.update({
+            "student_id": str(student_record["_id"]),
+            "role": student_record.get("role"),
+            "student_name": name,
+            "name": name,
+        })
         flash("Login successful", "success")
         return redirect(url_for('.student_dashboard'))
 
@@ -945,36 +1037,83 @@ def student_chat_send():
 @student_required
 def student_chat_history():
     student_id = session.get('student_id')
-    page = request.args.get('page',     1,  type=int)
-    per_page = request.args.get('per_page', 50, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    # A page is built in memory, so its size is capped
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1),
+                   _HISTORY_MAX_PER_PAGE)
+    after = request.args.get('after', '')
+    after_id = request.args.get('after_id', '')
+
+    # ?after=<next_cursor>&after_id=<next_cursor_id> seeks straight past the
+    # last message seen on the (student_id, timestamp, _id) index - keyset
+    # on both, as in admin_view_all_flags, since a writer batch can stamp
+    # several messages alike. ?page=N still works but walks every skipped
+    # message.
+    query = {'student_id': student_id}
     skip = (page - 1) * per_page
-
+    if after:
+        try:
+            after_at = datetime.datetime.fromisoformat(after)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        if after_id:
+            query['$or'] = [
+                {'timestamp': {'$gt': after_at}},
+                {'timestamp': after_at, '_id': {'$gt': after_id}},
+            ]
+        else:
+            query['timestamp'] = {'$gt': after_at}
+        skip = 0
+
+    # Messages are only appended, and retention cleanup only removes the
+    # oldest, so the oldest and newest ids pin down every page - plus the
+    # newest reply's length, which a streamed reply fills in after its
+    # message is saved. Both ends are read at once off the (student_id,
+    # timestamp) index; if the browser already has this version, nothing
+    # else is read.
+    oldest_f = _query_pool.submit(
+        messages.find_one, {'student_id': student_id}, {'_id': 1},
+        sort=[('timestamp', 1), ('_id', 1)])
+    latest_f = _query_pool.submit(
+        messages.find_one, {'student_id': student_id},
+        {'_id': 1, 'ai_response': 1}, sort=[('timestamp', -1), ('_id', -1)])
+    oldest, latest = oldest_f.result(), latest_f.result()
+    etag = hashlib.blake2b(
+        f"{oldest['_id'] if oldest else ''}:{latest['_id'] if latest else ''}:"
+        f"{len(latest.get('ai_response') or '') if latest else 0}:"
+        f"{page}:{per_page}:{after}:{after_id}".encode(),
+        digest_size=8
+    ).hexdigest()
+    if request.if_none_match.contains(etag):
+        return _revalidate(current_app.response_class(status=304), etag)
+
+    total_count, total_capped = bounded_count(
+        messages, {'student_id': student_id}, _HISTORY_COUNT_CAP)
+
+    # Already in response shape: _id comes back as message_id, and the
+    # app's JSON provider writes timestamps as ISO strings
     chat_history = list(messages.find(
-        {'student_id': student_id},
-        {'_id': 1, 'content': 1, 'ai_response': 1,
+        query,
+        {'_id': 0, 'message_id': '$_id', 'content': 1, 'ai_response': 1,
          'timestamp': 1, 'session_id': 1}
-    ).sort('timestamp', 1).skip(skip).limit(per_page))
-
-    formatted_messages = []
-    for msg in chat_history:
-        formatted_messages.append({
-            'message_id': msg['_id'],
-            'content':    msg['content'],
-            'ai_response': msg['ai_response'],
-            'timestamp':  msg['timestamp'].isoformat(),
-            'session_id': msg.get('session_id')
-        })
-
-    total_count = messages.count_documents({'student_id': student_id})
+    ).sort([('timestamp', 1), ('_id', 1)]).skip(skip).limit(per_page + 1))
+    has_more = len(chat_history) > per_page
+    del chat_history[per_page:]
 
-    return jsonify({
+    response = jsonify({
         'success':   True,
-        'messages':  formatted_messages,
+        'messages':  chat_history,
         'page':      page,
         'per_page':  per_page,
         'total':     total_count,
-        'has_more':  (skip + per_page) < total_count
+        'total_is_estimate': total_capped,
+        'has_more':  has_more,
+        'next_cursor': (chat_history[-1]['timestamp'].isoformat()
+                        if has_more else None),
+        'next_cursor_id': (chat_history[-1]['message_id']
+                           if has_more else None),
     })
+    return _revalidate(response, etag)
 
 
 # --------------------------------------------------
@@ -986,10 +1125,31 @@ def student_chat_history():
 def check_notifications():
     counselor_id = session.get('user_id')
 
-    unreviewed_count = flags.count_documents({
+    # Polled every 10s by each open dashboard. The body is serialized once
+    # and cached with its ETag; a poll that changes nothing gets a 304.
+    cached = notifications_cache.get(counselor_id)
+    if cached is None:
+        body = current_app.json.dumps(_compute_notifications(counselor_id))
+        etag = hashlib.blake2b(body.encode(), digest_size=8).hexdigest()
+        cached = (body, etag)
+        notifications_cache.set(counselor_id, cached)
+    body, etag = cached
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(body,
+                                              mimetype='application/json')
+    return _revalidate(response, etag)
+
+
+def _compute_notifications(counselor_id):
+    """Unreviewed-flag badge count plus the three newest flags"""
+    # The badge tops out at "99+", so stop counting past 100
+    unreviewed_count, count_capped = bounded_count(flags, {
         'counselor_id': counselor_id,
         'reviewed': False
-    })
+    }, _NOTIFICATION_COUNT_CAP, hint=FLAG_COUNSELOR_INDEX)
 
     latest_flags = list(flags.find({
         'counselor_id': counselor_id,
@@ -997,22 +1157,25 @@ def check_notifications():
     }, {
         'student_id': 1, 'risk_level': 1,
         'flagged_at': 1, 'detected_keywords': 1
-    }).sort('flagged_at', -1).limit(3))
+    }).hint(FLAG_COUNSELOR_INDEX).sort('flagged_at', -1).limit(3))
 
-    student_ids = [f['student_id'] for f in latest_flags]
-    student_map = {s['_id']: s['name'] for s in students.find(
-        {'_id': {'$in': student_ids}}, {'name': 1}
-    )}
+    student_map = {}
+    if latest_flags:
+        student_ids = [f['student_id'] for f in latest_flags]
+        student_map = {s['_id']: s['name'] for s in students.find(
+            {'_id': {'$in': student_ids}}, {'name': 1}
+        )}
 
     for flag in latest_flags:
         flag['student_name'] = student_map.get(flag['student_id'], 'Unknown')
 
-    return jsonify({
+    return {
         'count': unreviewed_count,
+        'count_capped': count_capped,
         'flags': [{
             'student_name': flag['student_name'],
             'risk_level': flag.get('risk_level', 'high'),
             'flagged_at': flag['flagged_at'].isoformat(),
             'keywords': flag.get('detected_keywords', [])
         } for flag in latest_flags]
-    })
+    }
@@ -1,8 +1,12 @@
 # app.py - Main Application Entry Point
-from flask import Flask
+from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
 import os
+import hashlib
+import orjson
 from dotenv import load_dotenv
 from User.routes import routes
+from User.database import setup_indexes
 from flask_mail import Mail
 
 load_dotenv()
@@ -18,6 +22,32 @@ if not secret_key:
     raise RuntimeError("SECRET_KEY not set in environment variables")
 app.secret_key = secret_key
 
+# Templates are compiled once and kept; only re-checked on disk while
+# developing (FLASK_DEBUG=true), not stat()ed on every render
+app.config['TEMPLATES_AUTO_RELOAD'] = (
+    os.getenv("FLASK_DEBUG", "false").lower() == "true")
+
+
+# --------------------------------------------------
+# JSON: orjson for jsonify() - it encodes datetimes itself, in the same
+# ISO form .isoformat() gives, so routes can return Mongo docs as-is.
+# NB: Flask's own provider writes a raw datetime as an RFC 822 HTTP date
+# ("Thu, 15 Oct 2026 07:39:00 GMT"); here it is ISO-8601. Every route
+# already sent .isoformat() strings, so no response changed - a route that
+# hands jsonify() a datetime gets ISO, never an HTTP date.
+# --------------------------------------------------
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # Types orjson doesn't know (Decimal, ...) fall back to Flask's
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = OrjsonProvider(app)
+
 # --------------------------------------------------
 # Mail Setup (for counselor–student communication)
 # --------------------------------------------------
@@ -40,18 +70,56 @@ if not app.config['MAIL_PASSWORD']:
 # Initialize Flask-Mail (must be done before registering blueprints)
 mail = Mail(app)
 
-# Verify mail extension is accessible
-print(f"Flask-Mail initialized: {mail is not None}")
-print(f"Mail in app.extensions: {'mail' in app.extensions}")
-
 # --------------------------------------------------
 # Register Blueprints
 # --------------------------------------------------
 app.register_blueprint(routes)
 
 
+# --------------------------------------------------
+# CLI: run once per deploy (release step), not in every worker
+# --------------------------------------------------
+@app.cli.command("ensure-indexes")
+def db_indexes():
+    """Create/verify MongoDB indexes."""
+    if not setup_indexes():
+        raise SystemExit(1)
+
+
+# --------------------------------------------------
+# Static assets: templates link them through url_for('static'), which
+# adds ?v=<content hash>. A versioned URL always serves the same bytes,
+# so browsers may keep it for a year; editing a file changes its URL.
+# --------------------------------------------------
+_static_versions = {}
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint != 'static' or 'v' in values:
+        return
+    filename = values.get('filename')
+    version = _static_versions.get(filename)
+    if version is None:
+        try:
+            with open(os.path.join(app.static_folder, filename), 'rb') as f:
+                version = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+        except OSError:
+            return
+        if not app.debug:   # pick up edits while developing
+            _static_versions[filename] = version
+    values['v'] = version
+
+
 @app.after_request
 def add_no_cache_headers(response):
+    if request.endpoint == 'static' and 'v' in request.args:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+    # Responses that choose their own caching (ETag'd JSON, unversioned
+    # static files) keep it; everything else must never be stored
+    if "Cache-Control" in response.headers:
+        return response
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, private"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
@@ -0,0 +1,11 @@
+# gunicorn.conf.py - read automatically by `gunicorn app:app` (Procfile, render.yaml)
+import os
+
+# Threaded workers: requests spend most of their time waiting on Mongo,
+# Anthropic or SMTP, and a streamed chat reply holds its request open
+# until the model finishes. With sync workers one such request blocked
+# every poll queued behind it.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
@@ -1,31 +1,66 @@
 """
 Migration Script: Add Token Expiration to Existing Students
-Run this ONCE after updating to the new system
+Run this ONCE after updating to the new system, from the repo root:
+    python migrate_token_expiration.py migrate
 """
 
-import datetime
+from datetime import datetime, timedelta
 import sys
-import os
-from User.database import students
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from bson import encode
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from User.database import students, utcnow, _read_only
 
-# Add the parent directory to path so we can import User module
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# A missing field is indexed as null, so {$exists: False} is answered from
+# the token_expires_at_1 index (created by ensure-indexes) - hint it so the
+# migration never falls back to a collection scan. A partial index can't
+# be used: partialFilterExpression doesn't accept $exists: False.
+MISSING_EXPIRY = {"token_expires_at": {"$exists": False}}
+EXPIRY_INDEX = [("token_expires_at", 1)]
 
+# verify/expired are reports: let a secondary answer them. The migration
+# itself (its count, writes and sample) stays on the primary.
+students_ro = _read_only(students)
 
-def migrate_student_tokens():
+# Updates go out in unordered bulk_write batches of this many students,
+# so no single write holds locks or fills the oplog for the whole set
+BATCH_SIZE = 1000
+
+# show_expired_tokens lists at most this many (most recently expired first)
+SHOW_LIMIT = 1000
+
+ROW_TIME_FORMAT = '%b %d, %Y %I:%M %p'
+
+
+def migrate_student_tokens(assume_yes=False, dry_run=False,
+                           batch_size=BATCH_SIZE, id_range=None):
     """
     Add token_created_at and token_expires_at to all existing students
-    without these fields
+    without these fields. id_range=(lo, hi) limits the run to students
+    with lo <= _id < hi (either may be None), so several runs can split
+    the collection between them.
     """
     print("=" * 60)
     print("IMHSS Token Expiration Migration")
     print("=" * 60)
     print()
 
+    query = dict(MISSING_EXPIRY)
+    if id_range:
+        lo, hi = id_range
+        bounds = {}
+        if lo:
+            bounds["$gte"] = lo
+        if hi:
+            bounds["$lt"] = hi
+        if bounds:
+            query["_id"] = bounds
+
     # Count students without expiration
-    students_without_expiration = students.count_documents({
-        "token_expires_at": {"$exists": False}
-    })
+    students_without_expiration = students.count_documents(
+        query, hint=EXPIRY_INDEX)
 
     print(f"Found {students_without_expiration}"
           "students without token expiration")
@@ -42,7 +77,12 @@ def migrate_student_tokens():
     print("  2. Set token_expires_at to 7 days from NOW")
     print()
 
-    confirm = input("Continue? (yes/no): ").strip().lower()
+    if dry_run:
+        print("Dry run - nothing written")
+        return
+
+    confirm = 'yes' if assume_yes else (
+        input("Continue? (yes/no): ").strip().lower())
 
     if confirm != 'yes':
         print("❌ Migration cancelled")
@@ -52,22 +92,32 @@ def migrate_student_tokens():
     print("🔄 Starting migration...")
 
     # Current timestamp
-    now = datetime.datetime.utcnow()
-    expires_at = now + datetime.timedelta(days=7)
-
-    # Update all students without expiration
-    result = students.update_many(
-        {"token_expires_at": {"$exists": False}},
-        {
-            "$set": {
-                "token_created_at": now,
-                "token_expires_at": expires_at
-            }
+    now = utcnow()
+    expires_at = now + timedelta(days=7)
+
+    # Update all students without expiration, batch_size at a time. The
+    # $set is the same for every student: encode it once and let each
+    # UpdateOne copy the bytes instead of re-encoding the dict.
+    update = RawBSONDocument(encode({
+        "$set": {
+            "token_created_at": now,
+            "token_expires_at": expires_at
         }
-    )
+    }))
+    cursor = students.find(query, {"_id": 1},
+                           hint=EXPIRY_INDEX).batch_size(batch_size)
+    modified = 0
+    ops = []
+    for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"], **MISSING_EXPIRY}, update))
+        if len(ops) == batch_size:
+            modified += students.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        modified += students.bulk_write(ops, ordered=False).modified_count
 
     print("✅ Migration complete!")
-    print(f"   Updated: {result.modified_count} students")
+    print(f"   Updated: {modified} students")
     print(f"   Token expires: {expires_at.strftime('%B %d, %Y at %I:%M %p')}")
     print()
     print("⚠️  NOTE: All existing tokens will expire in 7 days")
@@ -81,18 +131,14 @@ def migrate_student_tokens():
     sample_students = students.find(
         {"token_created_at": {"$exists": True}},
         {"name": 1, "access_token": 1, "token_expires_at": 1}
-    ).limit(5)
+    ).limit(5).batch_size(5)
 
-    for student in sample_students:
-        expires = student.get('token_expires_at')
-        expires_str = (
-            expires.strftime('%b %d, %Y %I:%M %p')
-            if expires else 'N/A'
-        )
-        print(
-            f"  • {student['name'][:30]:30} | Token: {student['access_token']}"
-            f"| Expires: {expires_str}"
-        )
+    # token_created_at and token_expires_at are always set together
+    sys.stdout.write("".join(
+        f"  • {student['name'][:30]:30} | Token: {student['access_token']}"
+        f"| Expires: {student['token_expires_at'].strftime(ROW_TIME_FORMAT)}\n"
+        for student in sample_students
+    ))
 
     print("-" * 60)
     print()
@@ -107,11 +153,16 @@ def verify_migration():
     print("=" * 60)
     print()
 
-    total_students = students.count_documents({})
-    students_with_expiration = students.count_documents({
-        "token_expires_at": {"$exists": True}
-    })
-    students_without_expiration = total_students - students_with_expiration
+    # Total from collection metadata; only the (usually empty) missing
+    # set is actually counted, off the expiry index. Both go out at once.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        total_future = pool.submit(students_ro.estimated_document_count)
+        missing_future = pool.submit(students_ro.count_documents,
+                                     MISSING_EXPIRY, hint=EXPIRY_INDEX)
+        total_students = total_future.result()
+        students_without_expiration = missing_future.result()
+    students_with_expiration = max(
+        total_students - students_without_expiration, 0)
 
     print(f"Total students: {total_students}")
     print(f"With expiration: {students_with_expiration}")
@@ -121,29 +172,27 @@ def verify_migration():
     if students_without_expiration == 0:
         print("✅ All students have token expiration!")
 
-        # Show expiration summary
-        now = datetime.datetime.utcnow()
-
-        expired = students.count_documents({
-            "token_expires_at": {"$lt": now}
-        })
-
-        expiring_soon = students.count_documents({
-            "token_expires_at": {
-                "$gte": now,
-                "$lt": now + datetime.timedelta(days=3)
-            }
-        })
-
-        active = students.count_documents({
-            "token_expires_at": {"$gte": now + datetime.timedelta(days=3)}
-        })
+        # Show expiration summary - every status count in one round
+        # trip; an empty bucket comes back as []
+        now = utcnow()
+        soon = now + timedelta(days=3)
+        buckets = {
+            "expired": {"token_expires_at": {"$lt": now}},
+            "expiring_soon": {"token_expires_at": {"$gte": now, "$lt": soon}},
+            "active": {"token_expires_at": {"$gte": soon}},
+        }
+        facets = next(students_ro.aggregate([{"$facet": {
+            name: [{"$match": match}, {"$count": "c"}]
+            for name, match in buckets.items()
+        }}]))
+        counts = {name: facet[0]["c"] if facet else 0
+                  for name, facet in facets.items()}
 
         print()
         print("Token Status Summary:")
-        print(f"  🔴 Expired: {expired} students")
-        print(f"  🟡 Expiring soon (< 3 days): {expiring_soon} students")
-        print(f"  🟢 Active (3+ days): {active} students")
+        print(f"  🔴 Expired: {counts['expired']} students")
+        print(f"  🟡 Expiring soon (< 3 days): {counts['expiring_soon']} students")
+        print(f"  🟢 Active (3+ days): {counts['active']} students")
 
     else:
         print("❌ Migration incomplete!")
@@ -165,44 +214,72 @@ def show_expired_tokens():
     print("=" * 60)
     print()
 
-    now = datetime.datetime.utcnow()
+    now = utcnow()
 
-    expired_students = list(students.find({
-        "token_expires_at": {"$lt": now}
-    }, {
-        "name": 1,
-        "access_token": 1,
-        "token_expires_at": 1,
-        "counselor_id": 1
-    }).sort("token_expires_at", -1))
+    expired_query = {"token_expires_at": {"$lt": now}}
+    expired_count = students_ro.count_documents(expired_query,
+                                                hint=EXPIRY_INDEX)
 
-    if not expired_students:
+    if not expired_count:
         print("✅ No expired tokens!")
         return
 
-    print(f"Found {len(expired_students)} expired tokens:")
+    print(f"Found {expired_count} expired tokens:")
+    if expired_count > SHOW_LIMIT:
+        print(f"  (showing the {SHOW_LIMIT} most recent)")
     print()
 
+    # Newest first: token_expires_at_1 walked backwards, so no in-memory
+    # sort - allow_disk_use=False makes the query fail rather than spill if
+    # that index is ever missing. Rows are small, so the whole capped list
+    # comes back in one batch.
+    expired_students = students_ro.find(
+        expired_query,
+        {"_id": 0, "name": 1, "token_expires_at": 1},
+        allow_disk_use=False
+    ).sort("token_expires_at", -1).limit(SHOW_LIMIT).batch_size(SHOW_LIMIT)
+
+    # Every row matched $lt, so token_expires_at is present. The listing
+    # is capped at SHOW_LIMIT rows, so it is built whole and written once
+    # rather than print()ed row by row
+    strftime = datetime.strftime
+    lines = []
     for student in expired_students:
-        expired_date = student.get('token_expires_at')
-        expired_str = (
-            expired_date.strftime('%b %d, %Y %I:%M %p')
-            if expired_date else 'Unknown'
-        )
-        days_ago = (now - expired_date).days if expired_date else 0
-
-        print(
-            f"  • {student['name'][:30]:30} | Expired: {expired_str} "
-            f"({days_ago} days ago)"
+        expired_date = student['token_expires_at']
+        lines.append(
+            f"  • {student['name'][:30]:30} | Expired: "
+            f"{strftime(expired_date, ROW_TIME_FORMAT)} "
+            f"({(now - expired_date).days} days ago)\n"
         )
+    sys.stdout.write("".join(lines))
 
     print()
     print("Counselors can regenerate these tokens from their dashboard")
     print()
 
 
-if __name__ == "__main__":
-    import sys
+def _id_range(value):
+    """'lo:hi' -> (lo, hi); either side may be left empty"""
+    lo, sep, hi = value.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected LO:HI")
+    return lo or None, hi or None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="IMHSS Token Expiration Migration Tool")
+    parser.add_argument("command", nargs="?", type=str.lower,
+                        help="migrate, verify or expired (prompted if omitted)")
+    parser.add_argument("--yes", action="store_true",
+                        help="migrate without asking for confirmation")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only count the students migrate would update")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="updates per bulk_write (default %(default)s)")
+    parser.add_argument("--id-range", type=_id_range, metavar="LO:HI",
+                        help="only migrate students with LO <= _id < HI")
+    args = parser.parse_args()
 
     print()
     print("IMHSS Token Expiration Migration Tool")
@@ -213,8 +290,8 @@ if __name__ == "__main__":
     print("  3. expired  - Show expired tokens")
     print()
 
-    if len(sys.argv) > 1:
-        command = sys.argv[1].lower()
+    if args.command:
+        command = args.command
     else:
         command = input("Enter command (migrate/verify/expired): ")
         command = command.strip().lower()
@@ -222,7 +299,9 @@ if __name__ == "__main__":
     print()
 
     if command == "migrate":
-        migrate_student_tokens()
+        migrate_student_tokens(assume_yes=args.yes, dry_run=args.dry_run,
+                               batch_size=max(args.batch_size, 1),
+                               id_range=args.id_range)
     elif command == "verify":
         verify_migration()
     elif command == "expired":
@@ -232,3 +311,7 @@ if __name__ == "__main__":
         print("   Use: migrate, verify, or expired")
 
     print()
+
+
+if __name__ == "__main__":
+    main()
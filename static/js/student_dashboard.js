@@ -230,10 +230,18 @@ async function sendMessage() {
             },
             body: JSON.stringify({
                 message: message,
-                session_id: currentSessionId
+                session_id: currentSessionId,
+                stream: true
             })
         });
 
+        // Streamed reply: show text as it arrives
+        const contentType = response.headers.get('Content-Type') || '';
+        if (response.ok && contentType.startsWith('text/event-stream')) {
+            await readStreamedReply(response);
+            return;
+        }
+
         const data = await response.json();
 
         // Hide typing indicator
@@ -252,6 +260,44 @@ async function sendMessage() {
     }
 }
 
+async function readStreamedReply(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const chatMessages = document.getElementById('chat-messages');
+    let buffer = '';
+    let reply = '';
+    let replyText = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-sent events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        events.forEach(event => {
+            if (!event.startsWith('data: ')) return;
+            const payload = JSON.parse(event.slice(6));
+            if (!payload.delta) return;
+
+            reply += payload.delta;
+            if (!replyText) {
+                hideTypingIndicator();
+                replyText = displayAIMessage('').querySelector('p');
+            }
+            replyText.textContent = reply;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+    }
+
+    if (!replyText) {
+        hideTypingIndicator();
+        displayAIMessage("I'm sorry, I'm having trouble responding right now. Please try again.");
+    }
+}
+
 function displayUserMessage(content, timestamp = new Date()) {
     const chatMessages = document.getElementById('chat-messages');
     const messageDiv = document.createElement('div');
@@ -282,6 +328,7 @@ function displayAIMessage(content, timestamp = new Date()) {
     
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
 }
 
 function showTypingIndicator() {
@@ -0,0 +1,144 @@
+"""Chat history and notification polling: 304s and keyset paging."""
+import datetime
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+os.environ.setdefault("SECRET_KEY", "test")
+
+from app import app  # noqa: E402
+from User import routes  # noqa: E402
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+        elif isinstance(cond, dict):
+            if "$gt" in cond and not doc[key] > cond["$gt"]:
+                return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+class _Cursor:
+    """Sorts on stored fields, projects on the way out - like a find()"""
+
+    def __init__(self, docs, project=dict):
+        self.docs = docs
+        self.project = project
+
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            self.docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    def skip(self, n):
+        self.docs = self.docs[n:]
+        return self
+
+    def limit(self, n):
+        return [self.project(d) for d in self.docs[:n]]
+
+
+class FakeMessages:
+    """Just the reads student_chat_history makes"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.find_calls = 0
+
+    def find(self, query, projection):
+        self.find_calls += 1
+        return _Cursor(
+            [d for d in self.docs if _matches(d, query)],
+            lambda d: {'message_id': d['_id'], 'content': d['content'],
+                       'ai_response': d['ai_response'],
+                       'timestamp': d['timestamp'],
+                       'session_id': d['session_id']})
+
+    def find_one(self, query, projection, sort):
+        docs = _Cursor([d for d in self.docs if _matches(d, query)])
+        found = docs.sort(sort).limit(1)
+        return found[0] if found else None
+
+
+def _message(i, timestamp):
+    return {'_id': f"m{i:02d}", 'student_id': 's1', 'session_id': 'x',
+            'content': f"message {i}", 'ai_response': 'reply',
+            'timestamp': timestamp}
+
+
+class ChatHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as s:
+            s['role'] = 'student'
+            s['student_id'] = 's1'
+        self.count = mock.patch.object(routes, 'bounded_count',
+                                       return_value=(0, False))
+        self.bounded_count = self.count.start()
+        self.addCleanup(self.count.stop)
+
+    def _use(self, docs):
+        fake = FakeMessages(docs)
+        patcher = mock.patch.object(routes, 'messages', fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake
+
+    def test_matching_etag_gets_304_without_reading_the_page(self):
+        fake = self._use([_message(1, datetime.datetime(2026, 1, 1))])
+        first = self.client.get('/student/chat/history')
+        self.assertEqual(first.status_code, 200)
+
+        again = self.client.get('/student/chat/history', headers={
+            'If-None-Match': first.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(fake.find_calls, 1)
+        self.assertEqual(self.bounded_count.call_count, 1)
+
+    def test_cursor_does_not_skip_equal_timestamps(self):
+        # Seven messages; a page boundary falls inside the run of five
+        # that share one timestamp
+        tied = datetime.datetime(2026, 1, 1, 12)
+        docs = [_message(0, tied - datetime.timedelta(seconds=1))]
+        docs += [_message(i, tied) for i in range(1, 6)]
+        docs += [_message(6, tied + datetime.timedelta(seconds=1))]
+        self._use(docs)
+
+        seen = []
+        url = '/student/chat/history?per_page=2'
+        while url:
+            body = self.client.get(url).get_json()
+            seen += [m['message_id'] for m in body['messages']]
+            url = body['has_more'] and (
+                '/student/chat/history?per_page=2'
+                f"&after={body['next_cursor']}"
+                f"&after_id={body['next_cursor_id']}")
+        self.assertEqual(seen, [d['_id'] for d in docs])
+
+
+class NotificationsTest(unittest.TestCase):
+    def test_matching_etag_gets_304(self):
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s['role'] = 'counselor'
+            s['user_id'] = 'c1'
+        routes.notifications_cache.clear()
+        body = {'count': 1, 'count_capped': False, 'flags': []}
+        with mock.patch.object(routes, '_compute_notifications',
+                               return_value=body) as compute:
+            first = client.get('/counselor/check-notifications')
+            self.assertEqual(first.status_code, 200)
+            again = client.get('/counselor/check-notifications', headers={
+                'If-None-Match': first.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(compute.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Streamed chat replies must not hold back a risk flag."""
+import os
+import unittest
+from unittest import mock
+
+# database.py refuses to import without a URI; the client connects lazily,
+# and every write below is intercepted before it would reach Mongo
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+
+from User import chat  # noqa: E402
+
+
+class StreamReplyFlagTest(unittest.TestCase):
+    def test_flag_queued_before_first_delta(self):
+        queued = []
+        seen_at_first_delta = []
+
+        def fake_stream(student_message, conversation_history):
+            seen_at_first_delta.append(list(queued))
+            yield "I'm here for you."
+
+        with mock.patch.object(chat, "_queue_write",
+                               lambda m, f=None: queued.append((m, f))), \
+                mock.patch.object(chat, "_queue_reply",
+                                  lambda i, r: queued.append((i, r))), \
+                mock.patch.object(chat.AIResponder, "stream_response",
+                                  fake_stream):
+            response = chat._stream_reply(
+                "I want to end it all", [], "student-1", "counselor-1",
+                "session-1", "high", 12, ["end it all"])
+
+            # Message and flag are queued before the response is returned
+            self.assertEqual(len(queued), 1)
+            message_doc, flag_doc = queued[0]
+            self.assertIsNotNone(flag_doc)
+            self.assertEqual(flag_doc["message_id"], message_doc["_id"])
+            self.assertEqual(message_doc["ai_response"], "")
+
+            events = list(response.response)
+
+        self.assertIn('"delta"', events[0])
+        self.assertEqual(len(seen_at_first_delta[0]), 1)
+        self.assertIsNotNone(seen_at_first_delta[0][0][1])
+        # The reply is filled in on that same message once the stream ends
+        self.assertEqual(queued[1], (message_doc["_id"], "I'm here for you."))
+        self.assertIn('"done"', events[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
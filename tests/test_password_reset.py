@@ -0,0 +1,46 @@
+"""A bogus reset token must be turned away before any password hashing."""
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+
+from User import models  # noqa: E402
+
+
+class ResetPasswordTest(unittest.TestCase):
+    def test_bogus_token_is_rejected_without_hashing(self):
+        with mock.patch.object(models, 'password_reset_tokens') as tokens, \
+                mock.patch.object(models, 'users') as users, \
+                mock.patch.object(models, 'hash_password') as hash_password:
+            tokens.find_one_and_update.return_value = None   # claim fails
+
+            ok = models.User.reset_password_with_token("not-a-token",
+                                                       "new-password-1")
+
+        self.assertFalse(ok)
+        tokens.find_one_and_update.assert_called_once()
+        hash_password.assert_not_called()
+        users.update_one.assert_not_called()
+
+    def test_claimed_token_sets_the_hashed_password(self):
+        with mock.patch.object(models, 'password_reset_tokens') as tokens, \
+                mock.patch.object(models, 'users') as users, \
+                mock.patch.object(models, 'logs_fast'), \
+                mock.patch.object(models, 'hash_password',
+                                  return_value="hashed") as hash_password:
+            tokens.find_one_and_update.return_value = {
+                'user_id': 'u1', 'email': 'c@example.com'}
+            users.update_one.return_value.matched_count = 1
+
+            ok = models.User.reset_password_with_token("token",
+                                                       "new-password-1")
+
+        self.assertTrue(ok)
+        hash_password.assert_called_once_with("new-password-1")
+        update = users.update_one.call_args.args[1]['$set']
+        self.assertEqual(update['hashed_password'], "hashed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""RiskDetector must report the same level, score and labels as a plain scan."""
+import os
+import random
+import unittest
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+
+from User.chat import RiskDetector  # noqa: E402
+
+
+def plain_scan(message_text):
+    """Reference: every pattern of every tier, one search each"""
+    normalised = RiskDetector._normalise(message_text)
+    if any(p.search(normalised) for p in RiskDetector._FALSE_POSITIVE_PATTERNS):
+        return ("none", [], 0)
+    score = 0
+    matched = []
+    for tier in (RiskDetector._CRITICAL, RiskDetector._SEVERE,
+                 RiskDetector._MODERATE):
+        for pattern, label, weight in tier:
+            if pattern.search(normalised):
+                score += weight
+                if label not in matched:
+                    matched.append(label)
+    if score >= 8:
+        return ("high", matched, score)
+    if score >= 4:
+        return ("medium", matched, score)
+    if score >= 3:
+        return ("low", matched, score)
+    return ("none", [], 0)
+
+
+# Pattern labels are mostly the phrase itself; the extras reach patterns
+# whose label isn't, plus the false-positive filters and non-ASCII text
+_EXTRA_FRAGMENTS = [
+    "i want to kill myself", "kms", "i'm going to end my life",
+    "I’m done", "can't sleep", "dying of laughter", "killing time",
+    "dead tired", "to die for", "café", "naïve", "so", "and", "today",
+    "my exam", "honestly", "😢", "lol", "my friend", "i think",
+]
+
+
+class RiskDetectorLabelTest(unittest.TestCase):
+    def test_multi_tier_message_keeps_every_label(self):
+        # Critical + severe alone pass Red Code (12); the moderate labels
+        # and their score must still be reported
+        level, labels, score = RiskDetector.detect(
+            "I want to kill myself. I feel hopeless and depressed, the "
+            "flashbacks never stop and I am so lonely")
+        self.assertEqual(level, "high")
+        self.assertEqual(labels, ['self-harm intent', 'hopeless',
+                                  'flashbacks', 'depressed', 'lonely'])
+        self.assertEqual(score, 24)
+
+
+
+class RiskDetectorParityTest(unittest.TestCase):
+    def test_matches_plain_scan(self):
+        fragments = [label for tier in (RiskDetector._CRITICAL,
+                                        RiskDetector._SEVERE,
+                                        RiskDetector._MODERATE)
+                     for _, label, _ in tier] + _EXTRA_FRAGMENTS
+        rng = random.Random(1234)
+        for _ in range(5000):
+            message = " ".join(rng.choice(fragments)
+                               for _ in range(rng.randint(1, 6)))
+            with self.subTest(message=message):
+                self.assertEqual(RiskDetector.detect(message),
+                                 plain_scan(message))
+
+
+if __name__ == "__main__":
+    unittest.main()